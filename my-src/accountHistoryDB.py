@@ -0,0 +1,184 @@
+import os
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+ACCOUNT_HISTORY_DB = 'stock/account_history.db'  # 账户历史数据库，analyze_summary.xlsx 由它按需导出
+
+# 三张历史表的列和类型。交收日期保存为'YYYY-MM-DD'文本，文本的大小顺序就是日期的先后顺序
+HISTORY_TABLES = {
+    '账户余额历史': {'交收日期': 'TEXT', '账户类型': 'TEXT', '累计净转入资金': 'REAL', '资金余额': 'REAL',
+                     '记录账户余额': 'REAL', '校验差异': 'REAL', '融资借款': 'REAL', '冻结资金': 'REAL',
+                     '当日市值': 'REAL', '资产净值': 'REAL', '盈亏': 'REAL'},
+    '股票持仓历史': {'交收日期': 'TEXT', '账户类型': 'TEXT', '证券代码': 'TEXT', '证券名称': 'TEXT',
+                     '持股数量': 'INTEGER', '持股成本': 'REAL', '当日市值': 'REAL', '浮动盈亏': 'REAL', '备注': 'TEXT'},
+    '个股盈亏历史': {'交收日期': 'TEXT', '账户类型': 'TEXT', '证券代码': 'TEXT', '证券名称': 'TEXT',
+                     '持股数量': 'INTEGER', '实现盈亏': 'REAL'},
+}
+DATE_FORMAT = '%Y-%m-%d'
+ROW_INDEX_TABLE = '日期行索引'  # 每张历史表中每个交收日期的行所在的rowid区间
+VALUATION_TABLE = '估值进度'  # 每个账户的当日市值、资产净值和盈亏已经计算到的交收日期
+# 数据库结构的版本，保存在SQLite的 user_version 中。版本不一致（新建的或较早版本写入的数据库）时才建表、建索引
+SCHEMA_VERSION = 1
+
+
+# 每日资金余额、每日持仓和个股实现盈亏三张历史表的SQLite数据库。
+# 每张表都在 (交收日期, 账户类型[, 证券代码]) 上建索引；表内的行按交收日期的先后连续存放，
+# 行的先后顺序（rowid）与原来Excel中各sheet的行顺序一致。
+# 日期行索引表记录每个交收日期的起始rowid和行数，按日期区间读取、替换某日期之后的数据都只需要按rowid区间操作
+class AccountHistoryDB:
+    def __init__(self, db_file=ACCOUNT_HISTORY_DB):
+        self.db_file = db_file
+
+    def exists(self):
+        return os.path.exists(self.db_file)
+
+    # 打开数据库，数据库结构不是当前版本时先升级
+    def connect(self):
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_file)
+        if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.upgrade_schema(conn)
+        return conn
+
+    # 创建没有的表和索引，为还没有日期行索引的表生成索引，然后记录数据库结构的版本
+    def upgrade_schema(self, conn):
+        for table, columns in HISTORY_TABLES.items():
+            column_defs = ', '.join(f'"{col}" {col_type}' for col, col_type in columns.items())
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({column_defs})')
+            index_columns = ', '.join(f'"{col}"' for col in ['交收日期', '账户类型', '证券代码'] if col in columns)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_日期索引" ON "{table}" ({index_columns})')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{ROW_INDEX_TABLE}" ("表名" TEXT, "交收日期" TEXT, '
+                     f'"起始行" INTEGER, "行数" INTEGER, PRIMARY KEY ("表名", "交收日期"))')
+        for table in HISTORY_TABLES:
+            self.build_row_index(conn, table)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{VALUATION_TABLE}" ("账户类型" TEXT PRIMARY KEY, "估值日期" TEXT)')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+
+    # 还没有日期行索引的表（例如较早版本写入的数据库）按表中的数据生成索引
+    @staticmethod
+    def build_row_index(conn, table):
+        if conn.execute(f'SELECT 1 FROM "{ROW_INDEX_TABLE}" WHERE "表名" = ? LIMIT 1', [table]).fetchone() or \
+                not conn.execute(f'SELECT 1 FROM "{table}" LIMIT 1').fetchone():
+            return
+        conn.execute(f'INSERT INTO "{ROW_INDEX_TABLE}" SELECT ?, "交收日期", MIN(rowid), COUNT(*) '
+                     f'FROM "{table}" GROUP BY "交收日期"', [table])
+
+    # 交收日期在 [start_date, end_date] 之间的查询条件（接在其它条件之后）和参数
+    @staticmethod
+    def date_where(start_date=None, end_date=None):
+        where, params = '', []
+        if start_date is not None:
+            where += ' AND "交收日期" >= ?'
+            params.append(pd.Timestamp(start_date).strftime(DATE_FORMAT))
+        if end_date is not None:
+            where += ' AND "交收日期" <= ?'
+            params.append(pd.Timestamp(end_date).strftime(DATE_FORMAT))
+        return where, params
+
+    # 交收日期在 [start_date, end_date] 之间的行的rowid区间 [first_row, end_row)，没有这样的行时返回None
+    @staticmethod
+    def row_range(conn, table, start_date=None, end_date=None):
+        where, params = AccountHistoryDB.date_where(start_date, end_date)
+        first_row, end_row = conn.execute(
+            f'SELECT MIN("起始行"), MAX("起始行" + "行数") FROM "{ROW_INDEX_TABLE}" WHERE "表名" = ?{where}',
+            [table] + params).fetchone()
+        return None if first_row is None else (first_row, end_row)
+
+    # 读取一张表中交收日期在 [start_date, end_date] 之间的行（两端都可以为None）
+    def read(self, table, start_date=None, end_date=None):
+        columns = list(HISTORY_TABLES[table])
+        select_columns = ', '.join(f'"{col}"' for col in columns)
+        with closing(self.connect()) as conn:
+            # 按日期行索引找到这段日期的rowid区间，只读取区间内的行
+            rows = self.row_range(conn, table, start_date, end_date) or (0, 0)
+            frame = pd.read_sql_query(f'SELECT {select_columns} FROM "{table}" WHERE rowid >= ? AND rowid < ? '
+                                      f'ORDER BY rowid', conn, params=list(rows))
+        frame['交收日期'] = pd.to_datetime(frame['交收日期'], format=DATE_FORMAT)
+        return frame
+
+    # 表中最近的交收日期，before_date不为None时只看它之前（不含）的日期；表为空时返回None
+    def latest_date(self, table, before_date=None):
+        where, params = '', []
+        if before_date is not None:
+            where, params = ' AND "交收日期" < ?', [pd.Timestamp(before_date).strftime(DATE_FORMAT)]
+        with closing(self.connect()) as conn:
+            latest = conn.execute(f'SELECT MAX("交收日期") FROM "{ROW_INDEX_TABLE}" WHERE "表名" = ?{where}',
+                                  [table] + params).fetchone()[0]
+        return None if latest is None else pd.to_datetime(latest, format=DATE_FORMAT)
+
+    def upsert_range(self, table, start_date, frame):
+        """
+        用frame替换表中交收日期在start_date（含）之后的行，start_date为None时替换整张表。
+        只删除start_date之后的rowid区间，新数据接着start_date之前的最后一行写入，并就地更新日期行索引，
+        代价只与替换的行数有关，与表中已有的历史长短无关
+
+        :param table: 表名，HISTORY_TABLES中的一个
+        :param start_date: 替换的开始日期
+        :param frame: 新数据，其中start_date之前的行会被忽略
+        """
+        columns = list(HISTORY_TABLES[table])
+        if start_date is not None and len(frame) > 0:
+            frame = frame[frame['交收日期'] >= start_date]
+        # 同一日期的行保持原来的顺序
+        frame = frame.reindex(columns=columns).sort_values('交收日期', kind='stable')
+        frame['交收日期'] = pd.to_datetime(frame['交收日期']).dt.strftime(DATE_FORMAT)
+        frame = frame.astype(object).where(frame.notna(), None)
+
+        with closing(self.connect()) as conn:
+            with conn:  # 删除、写入和更新索引在同一个事务中
+                where, params = self.date_where(start_date)
+                rows = self.row_range(conn, table, start_date)
+                if rows is not None:
+                    conn.execute(f'DELETE FROM "{table}" WHERE rowid >= ?', [rows[0]])
+                conn.execute(f'DELETE FROM "{ROW_INDEX_TABLE}" WHERE "表名" = ?{where}', [table] + params)
+                # 新数据从剩下的最后一行之后开始编号
+                first_row = conn.execute(f'SELECT COALESCE(MAX(rowid), 0) + 1 FROM "{table}"').fetchone()[0]
+
+                insert_columns = ', '.join(['rowid'] + [f'"{col}"' for col in columns])
+                placeholders = ', '.join(['?'] * (len(columns) + 1))
+                conn.executemany(f'INSERT INTO "{table}" ({insert_columns}) VALUES ({placeholders})',
+                                 ((first_row + offset,) + record for offset, record in
+                                  enumerate(frame.itertuples(index=False, name=None))))
+                date_counts = frame.groupby('交收日期', sort=False).size()
+                conn.executemany(f'INSERT INTO "{ROW_INDEX_TABLE}" VALUES (?, ?, ?, ?)',
+                                 ((table, trade_date, first_row + int(offset), int(count)) for trade_date, offset, count
+                                  in zip(date_counts.index, date_counts.cumsum() - date_counts, date_counts)))
+
+    # 每个账户已经估值到的交收日期 {账户类型: 估值日期}，没有估值过的账户不在其中
+    def valued_dates(self):
+        with closing(self.connect()) as conn:
+            rows = conn.execute(f'SELECT "账户类型", "估值日期" FROM "{VALUATION_TABLE}"').fetchall()
+        return {account: pd.to_datetime(valued_date, format=DATE_FORMAT) for account, valued_date in rows}
+
+    # 记录账户已经估值到的交收日期
+    def set_valued_dates(self, valued_dates):
+        with closing(self.connect()) as conn:
+            with conn:
+                conn.executemany(f'INSERT OR REPLACE INTO "{VALUATION_TABLE}" VALUES (?, ?)',
+                                 [(account, pd.Timestamp(valued_date).strftime(DATE_FORMAT))
+                                  for account, valued_date in valued_dates.items()])
+
+    # start_date（含）之后的记录重新生成后还没有估值，估值日期退回到start_date的前一天；start_date为None时全部清除
+    def reset_valued_dates(self, start_date=None):
+        with closing(self.connect()) as conn:
+            with conn:
+                if start_date is None:
+                    conn.execute(f'DELETE FROM "{VALUATION_TABLE}"')
+                else:
+                    start_date = pd.Timestamp(start_date).strftime(DATE_FORMAT)
+                    prev_date = (pd.Timestamp(start_date) - pd.Timedelta(days=1)).strftime(DATE_FORMAT)
+                    conn.execute(f'UPDATE "{VALUATION_TABLE}" SET "估值日期" = ? WHERE "估值日期" >= ?',
+                                 [prev_date, start_date])
+
+    # 从旧的analyze_summary.xlsx导入三张历史表
+    def import_excel(self, excel_file):
+        sheets = pd.read_excel(excel_file, sheet_name=list(HISTORY_TABLES), dtype={'证券代码': str})
+        for table, frame in sheets.items():
+            # 旧文件中增量追加时补充的空行没有交收日期
+            frame = frame.dropna(subset=['交收日期'])
+            self.upsert_range(table, None, frame)
@@ -13,44 +13,35 @@ from stockPriceHistory import StockPriceHistory
 
 
 def cal_market_value(stock_holding_records, stock_price_df):
-    # 转换交收日期为日期格式，并初始化当日市值为0
+    # 转换交收日期为日期格式
     stock_holding_records['交收日期'] = pd.to_datetime(stock_holding_records['交收日期'])
-    stock_holding_records['当日市值'] = 0.0
+
+    # 只用有收盘价的记录，同一股票同一天有多条时取第一条；代码和日期的类型与持仓记录一致，以便合并
+    price_df = stock_price_df.loc[stock_price_df['收盘'].notnull(), ['证券代码', '日期', '收盘']]
+    price_df = price_df.drop_duplicates(['证券代码', '日期']).astype(
+        {'证券代码': stock_holding_records['证券代码'].dtype, '日期': stock_holding_records['交收日期'].dtype})
 
     # 合并持仓记录与股票价格数据
-    merged_df = pd.merge(stock_holding_records, stock_price_df[['证券代码', '日期', '收盘']], how='left',
+    merged_df = pd.merge(stock_holding_records, price_df, how='left',
                          left_on=['证券代码', '交收日期'], right_on=['证券代码', '日期'])
 
-    # 对正常有收盘价的，更新当日市值
-    merged_df['当日市值'] = merged_df.apply(
-        lambda row: row['当日市值'] if pd.isnull(row['收盘']) else row['收盘'] * row['持股数量'],
-        axis=1
-    )
-
-    # 初始化备注列
-    merged_df['备注'] = ''
-
-    # 筛选出收盘价缺失的行
-    missing_close_prices = merged_df[merged_df['收盘'].isnull()]
-
-    # 留存有收盘价的记录，用于更新当日市值
-    temp_history_df = stock_price_df[stock_price_df['收盘'].notnull()]
-
-    # 遍历收盘价缺失的记录，尝试查找上一个交易日的市值
-    for index, row in missing_close_prices.iterrows():
-        security_code = row['证券代码']
-        settlement_date = row['交收日期']
-
-        # 查找上一个交易日的股价
-        previous_price = find_previous_market_value(temp_history_df, security_code, settlement_date)
-        if pd.notnull(previous_price):
-            merged_df.at[index, '当日市值'] = previous_price * row['持股数量']
-            merged_df.at[index, '备注'] = '停牌'
-        else:
-            # 添加持股成本小于0时按0赋值的逻辑
-            holding_cost = max(0, row['持股成本'])
-            merged_df.at[index, '当日市值'] = holding_cost
-            merged_df.at[index, '备注'] = '估算'
+    # 收盘价缺失的行，一次按证券代码找到交收日期之前（不含当天）最近一个交易日的收盘价
+    missing = merged_df['收盘'].isnull()
+    missing_rows = merged_df.loc[missing, ['证券代码', '交收日期']].sort_values('交收日期', kind='stable')
+    previous_prices = pd.merge_asof(missing_rows.reset_index(),
+                                    price_df.rename(columns={'日期': '前收盘日期', '收盘': '前收盘'})
+                                    .sort_values('前收盘日期', kind='stable'),
+                                    left_on='交收日期', right_on='前收盘日期', by='证券代码',
+                                    direction='backward', allow_exact_matches=False)
+    previous_close = previous_prices.set_index('index')['前收盘'].reindex(merged_df.index)
+
+    # 正常有收盘价的，按收盘价计算当日市值；停牌的按停牌前的收盘价计算；
+    # 找不到任何收盘价的按持股成本估算，持股成本小于0时按0赋值
+    suspended = missing & previous_close.notnull()
+    estimated = missing & previous_close.isnull()
+    merged_df['当日市值'] = merged_df['收盘'].fillna(previous_close) * merged_df['持股数量']
+    merged_df.loc[estimated, '当日市值'] = merged_df.loc[estimated, '持股成本'].clip(lower=0)
+    merged_df['备注'] = np.select([suspended, estimated], ['停牌', '估算'], default='')
 
     # 计算浮动盈亏
     merged_df['浮动盈亏'] = merged_df['当日市值'] - merged_df['持股成本']
@@ -62,16 +53,6 @@ def cal_market_value(stock_holding_records, stock_price_df):
     return merged_df
 
 
-def find_previous_market_value(stock_price_df, security_code, settlement_date):
-    # 查找上一个交易日的市值
-    previous_dates = stock_price_df[
-        (stock_price_df['证券代码'] == security_code) & (stock_price_df['日期'] < settlement_date)]
-    if not previous_dates.empty:
-        latest_date = previous_dates['日期'].max()
-        return previous_dates.loc[previous_dates['日期'] == latest_date, '收盘'].values[0]
-    return None
-
-
 # 计算账户市值
 def cal_account_profit(df_market_value, account_balance_records):
     # 使用groupby和sum函数按日期分组求和当日账户资产净值市值
@@ -121,14 +102,84 @@ def analyze_and_update(start_date=None):
 
     if start_date is None:
         start_date = pd.to_datetime('20070501', format='%Y%m%d')
-    with pd.ExcelWriter(AccountSummary.ACCOUNT_SUMMARY_FILE, engine='openpyxl',
-                        mode='a', if_sheet_exists='overlay') as writer:
-        # 将数据写入Excel文件的不同sheet
-        account_summary.append_data_to_sheet(writer, '账户余额历史', df_account_profit, start_date)
-        account_summary.append_data_to_sheet(writer, '股票持仓历史', df_market_value, start_date)
+    # 将估值结果写回账户历史数据库（需要Excel报表时调用 AccountSummary.export_account_summary_file 导出）
+    history_db = account_summary.history_db()
+    history_db.upsert_range('账户余额历史', start_date, df_account_profit)
+    history_db.upsert_range('股票持仓历史', start_date, df_market_value)
+    # 各账户都已经估值到最新的交收日期
+    history_db.set_valued_dates(df_account_profit.groupby('账户类型')['交收日期'].max().to_dict())
 
-    # 设置数据格式
-    account_summary.format_account_summary_file()
+
+# 增量估值：每个账户只估值上次估值之后的新交易日，以及持有的股票收盘价被价格存储新增或修正之后的交易日，
+# 更早的日子保留数据库中已有的当日市值、资产净值和盈亏
+def update_valuation():
+    account_summary = AccountSummary()
+    history_db = account_summary.history_db()
+    price_store = StockPriceHistory().get_price_store()
+    # 本次处理的收盘价修正记录，估值完成后删除；估值过程中新压缩产生的修正留到下一次处理
+    revision_files = price_store.list_revision_files()
+    revisions = price_store.read_revisions(revision_files)
+    valued_dates = history_db.valued_dates()
+
+    # 只需要加载最早可能重新估值的日期之后的记录，有账户还没有估值过时加载全部
+    if valued_dates:
+        read_from = min(valued_dates.values()) + pd.Timedelta(days=1)
+        if len(revisions) > 0:
+            read_from = min(read_from, revisions['日期'].min())
+    else:
+        read_from = None
+    stock_holding_records, account_balance_records = account_summary.load_account_summaries(read_from)
+
+    valuation_starts = get_valuation_starts(stock_holding_records, account_balance_records, valued_dates, revisions)
+    holding_mask = stock_holding_records['交收日期'] >= pd.to_datetime(
+        stock_holding_records['账户类型'].map(valuation_starts))
+    balance_mask = account_balance_records['交收日期'] >= pd.to_datetime(
+        account_balance_records['账户类型'].map(valuation_starts))
+    if not balance_mask.any():
+        print("没有需要估值的交易日")
+        price_store.clear_revisions(revision_files)
+        return
+    write_from = account_balance_records.loc[balance_mask, '交收日期'].min()
+    print(f"重新估值{balance_mask.sum()}条账户余额记录、{holding_mask.sum()}条持仓记录，从{write_from}开始写回")
+
+    # 加载需要估值的股票的全部收盘价（停牌时要用到估值日期之前的收盘价）
+    stock_price_df = StockPriceHistory().get_stock_price_df(
+        codes=stock_holding_records.loc[holding_mask, '证券代码'].unique())
+    stock_price_df['收盘'] = stock_price_df['收盘'].astype(float)
+    df_market_value = cal_market_value(stock_holding_records[holding_mask].copy(), stock_price_df)
+    df_total_profit, df_account_profit = cal_account_profit(df_market_value, account_balance_records[balance_mask])
+
+    # 估值结果按原来的行位置替换，不需要估值的行保持原值
+    df_market_value.index = stock_holding_records.index[holding_mask]
+    df_account_profit.index = account_balance_records.index[balance_mask]
+    stock_holding_records = pd.concat([stock_holding_records[~holding_mask], df_market_value]).sort_index()
+    account_balance_records = pd.concat([account_balance_records[~balance_mask], df_account_profit]).sort_index()
+
+    history_db.upsert_range('账户余额历史', write_from, account_balance_records)
+    history_db.upsert_range('股票持仓历史', write_from, stock_holding_records)
+    history_db.set_valued_dates(account_balance_records.groupby('账户类型')['交收日期'].max().to_dict())
+    price_store.clear_revisions(revision_files)
+
+
+# 每个账户需要重新估值的开始日期：上次估值日期的下一天，持有的股票收盘价被修正时提前到修正日期之后第一个持有它的交易日。
+# 还没有估值过的账户从头开始
+def get_valuation_starts(stock_holding_records, account_balance_records, valued_dates, revisions):
+    revisions = revisions.rename(columns={'日期': '修正日期'}).astype(
+        {'证券代码': stock_holding_records['证券代码'].dtype})
+    revised_holdings = stock_holding_records.merge(revisions, on='证券代码')
+    revised_starts = revised_holdings.loc[revised_holdings['交收日期'] >= revised_holdings['修正日期']].groupby(
+        '账户类型')['交收日期'].min()
+
+    valuation_starts = {}
+    for account in account_balance_records['账户类型'].unique():
+        if account in valued_dates:
+            valuation_start = valued_dates[account] + pd.Timedelta(days=1)
+        else:
+            valuation_start = account_balance_records['交收日期'].min()
+        if account in revised_starts.index:
+            valuation_start = min(valuation_start, revised_starts[account])
+        valuation_starts[account] = valuation_start
+    return valuation_starts
 
 
 # 绘制盈利图像
@@ -307,16 +358,17 @@ def get_sim_account_history(checkpoint_date):
 def get_trade_dates(start_date):
     # 获取当前日期
     today = datetime.date.today()
-    # 获取所有的交易日日期
-    trade_dates = StockPriceHistory.load_trade_dates()
-    # 筛选出指定范围内的交易日
-    filtered_dates = trade_dates[(trade_dates['trade_date'] >= start_date) & (trade_dates['trade_date'] <= today)]
-    return filtered_dates['trade_date']
+    # 从交易日历中取出指定范围内的交易日
+    return StockPriceHistory.get_trade_calendar().range(start_date, today).to_series(name='trade_date')
 
 
-def run():
+# export_summary 为True时把账户历史数据库导出为 analyze_summary.xlsx，导出要读写全部历史，只在需要查看报表时打开
+def run(export_summary=False):
     start_date = pd.to_datetime('20070501', format='%Y%m%d')
-    analyze_and_update(start_date)
+    # 只估值新的交易日和收盘价修正过的日子，需要全部重新估值时调用 analyze_and_update(start_date)
+    update_valuation()
+    if export_summary:
+        AccountSummary.export_account_summary_file()
     draw_profit(start_date)
 
     # checkpoint_date = pd.to_datetime('20231124', format='%Y%m%d')
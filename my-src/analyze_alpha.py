@@ -1,3 +1,4 @@
+from reportExporter import ReportSheet, export_report
 from stockPriceHistory import StockPriceHistory
 import pandas as pd
 import numpy as np
@@ -12,7 +13,7 @@ class StockAnalyzer:
         self.stock_price_handler = StockPriceHistory()
 
     def get_exchange_rate(self):
-        return StockPriceHistory.cache_exchange_rate_from_ak()
+        return StockPriceHistory.get_exchange_rate_df()
 
     def get_price_data(self, code):
         exchange_rate_df = self.get_exchange_rate()
@@ -130,13 +131,9 @@ class StockAnalyzer:
         return result_df
 
     def save_to_excel(self, df, output_file):
-        with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Analysis', index=False)
-            workbook = writer.book
-            worksheet = writer.sheets['Analysis']
-            worksheet.set_column('J:J', 50)
-            wrap_format = workbook.add_format({'text_wrap': True})
-            worksheet.set_column('J:J', 50, wrap_format)
+        # 解读列固定宽度并自动换行
+        export_report(output_file, ReportSheet('Analysis', df, formats={'解读': {'text_wrap': True}},
+                                               widths={'解读': 50}))
         print(f"分析结果已保存到 {output_file}")
 
 def main():
@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 一个抓取任务：key 用于汇报失败（一般是证券代码），endpoint 用于按接口限速，func(**kwargs) 执行实际请求
+FetchTask = namedtuple('FetchTask', ['key', 'endpoint', 'func', 'kwargs'])
+
+
+# 按接口限速：同一个接口相邻两次请求之间至少间隔 min_interval 秒（多线程共享）
+class RateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# 有界线程池抓取器：按接口限速，失败后按指数退避加随机抖动重试
+class FetchExecutor:
+    def __init__(self, max_workers=4, rate_limits=None, default_interval=0.2, max_retries=3, backoff_base=1.0,
+                 backoff_max=30.0):
+        self.max_workers = max_workers
+        self.rate_limits = rate_limits or {}  # endpoint -> 最小请求间隔（秒）
+        self.default_interval = default_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def get_limiter(self, endpoint):
+        with self._limiters_lock:
+            if endpoint not in self._limiters:
+                self._limiters[endpoint] = RateLimiter(self.rate_limits.get(endpoint, self.default_interval))
+            return self._limiters[endpoint]
+
+    # 第attempt次重试前的等待时间：指数退避，在[0, 上限]之间随机抖动，避免多个线程同时重试
+    def backoff_time(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def call_with_retry(self, task):
+        limiter = self.get_limiter(task.endpoint)
+        for attempt in range(self.max_retries + 1):
+            limiter.wait()
+            try:
+                return task.func(**task.kwargs)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                wait_time = self.backoff_time(attempt)
+                print(f"Retry {attempt + 1}/{self.max_retries} for {task.key} ({task.endpoint}) "
+                      f"in {wait_time:.1f}s. Error: {e}")
+                time.sleep(wait_time)
+
+    def run(self, tasks):
+        """
+        并发执行抓取任务
+
+        :param tasks: FetchTask 列表
+        :return: (results, failed_keys)，results 为与 tasks 顺序一致的返回值列表（失败的任务为 None），
+                 failed_keys 为重试后仍然失败的任务 key 列表
+        """
+        results = [None] * len(tasks)
+        failed_keys = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.call_with_retry, task): index for index, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    print(f"Failed to fetch data for {tasks[index].key} ({tasks[index].endpoint}). Error: {e}")
+                    failed_keys.append(tasks[index].key)
+        return results, failed_keys
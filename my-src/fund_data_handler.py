@@ -1,8 +1,8 @@
 from datetime import datetime
 
-import akshare as ak
 import pandas as pd
-from akshare import stock_hk_hist
+
+from marketDataProvider import get_provider
 
 
 class FundDataHandler:
@@ -56,7 +56,7 @@ class FundDataHandler:
     @staticmethod
     def get_fund_info(fund_code):
         try:
-            fund_graded_fund_info_em_df = ak.fund_graded_fund_info_em(fund=fund_code)
+            fund_graded_fund_info_em_df = get_provider().fetch('fund_graded_fund_info_em', fund=fund_code)
             if fund_graded_fund_info_em_df.empty:
                 print(f"Error: No data found for fund {fund_code}")
                 return pd.DataFrame()
@@ -104,7 +104,8 @@ class FundDataHandler:
 
     @staticmethod
     def etf_fund_hist(stock_code: str, start_date: str, end_date: str):
-        stock_hist_df = ak.fund_etf_fund_info_em(fund=stock_code, start_date=start_date, end_date=end_date)
+        stock_hist_df = get_provider().fetch('fund_etf_fund_info_em', fund=stock_code, start_date=start_date,
+                                             end_date=end_date)
         stock_hist_df.rename(columns={'净值日期': '日期', '单位净值': '收盘'}, inplace=True)
         stock_hist_df = stock_hist_df[['日期', '收盘']]
         return stock_hist_df
@@ -113,7 +114,7 @@ class FundDataHandler:
     def hk_index_hist(symbol: str, start_date: str, end_date: str):
         start_date =pd.to_datetime(start_date)
         end_date = pd.to_datetime(end_date)
-        stock_hist_df = ak.stock_hk_index_daily_sina(symbol=symbol)
+        stock_hist_df = get_provider().fetch('stock_hk_index_daily_sina', symbol=symbol)
         stock_hist_df.rename(columns={'date': '日期', 'close': '收盘'}, inplace=True)
         stock_hist_df['日期'] = pd.to_datetime(stock_hist_df['日期'])
         stock_hist_df = stock_hist_df[(stock_hist_df['日期'] >= start_date) & (stock_hist_df['日期']<=end_date)]
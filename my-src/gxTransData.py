@@ -1,7 +1,11 @@
+import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
 import os
 
+from accountHistoryDB import AccountHistoryDB
+from historyBuilder import HistoryBuilder
+from reportExporter import ReportSheet, export_report
+
 # 国信证券交易资金流水中根据摘要对成交数量和发生金额的处理系数定义
 class SummaryClassifier:
     SUMMARY_CLASSIFICATION = {
@@ -95,10 +99,51 @@ class SummaryClassifier:
             account_type = '国信B股'
         return account_type
 
+    # 摘要 -> 各标志的查找表，由 SUMMARY_CLASSIFICATION 生成
+    FLAG_COLUMNS = ['成交数量标志', '发生金额标志', '银行标志', '融资流水', '冻结流水']
+    _summary_table = None
+
+    @classmethod
+    def summary_table(cls):
+        if cls._summary_table is None:
+            table = pd.DataFrame.from_dict(cls.SUMMARY_CLASSIFICATION, orient='index')
+            table['银行标志'] = table['银行标志'].fillna(0).astype(int)
+            table['融资流水'] = table.index.isin(cls.RONGZI_CASHFLOW_SUMMARY)
+            table['冻结流水'] = table.index.isin(cls.FROZEN_CASHFLOW_SUMMARY)
+            cls._summary_table = table[cls.FLAG_COLUMNS]
+        return cls._summary_table
+
+    @classmethod
+    def annotate(cls, data):
+        """
+        给整个交易流水表一次性加上分类列：
+        成交数量标志、发生金额标志、银行标志、融资流水（属于RONGZI_CASHFLOW_SUMMARY）、冻结流水（属于FROZEN_CASHFLOW_SUMMARY）、账户类型
+        :param data: 交易流水，需要有'摘要'、'货币代码'、'融资账户'列
+        :return: 加上分类列后的交易流水
+        :raises ValueError: 流水中有 SUMMARY_CLASSIFICATION 中没有定义的摘要
+        """
+        summaries = pd.Categorical(data['摘要'])
+        table = cls.summary_table().reindex(summaries.categories)
+        # 只检查实际出现的摘要（分类列里可能还有被日期过滤掉的类别），摘要为空的编码是-1
+        unknown = ['(空)' if code < 0 else summaries.categories[code] for code in np.unique(summaries.codes)
+                   if code < 0 or pd.isna(table['成交数量标志'].iloc[code])]
+        if unknown:
+            raise ValueError(f"交易流水中有未定义的摘要：{unknown}，请先在SummaryClassifier.SUMMARY_CLASSIFICATION中定义")
+
+        data = data.copy()
+        for col in cls.FLAG_COLUMNS:
+            dtype = bool if col in ('融资流水', '冻结流水') else int
+            data[col] = table[col].to_numpy()[summaries.codes].astype(dtype) if len(data) > 0 else \
+                np.array([], dtype=dtype)
+        data['账户类型'] = np.select([data['融资账户'] == '是', data['货币代码'] == '人民币'],
+                                 ['国信融资账户', '国信账户'], default='国信B股')
+        return data
+
 
 # 国信证券交易资金流水中的初始持仓
 class AccountSummary:
-    ACCOUNT_SUMMARY_FILE = 'analyze_summary.xlsx'
+    ACCOUNT_SUMMARY_FILE = 'analyze_summary.xlsx'  # 由账户历史数据库按需导出的Excel报表
+    HISTORY_SHEETS = ['账户余额历史', '股票持仓历史', '个股盈亏历史']
     # 每只股票在初始20070507时点的初始持仓股数
     INIT_HOLDINGS = {  # 持股成本价以20070507时的不复权股价为计算依据
         '600161': {'交收日期': '20070507', '账户': '国信账户', '证券名称': '天坛生物', '持股数量': 12000, '持股成本价': 20.42},
@@ -116,9 +161,10 @@ class AccountSummary:
     }
 
     def __init__(self):
-        self.stockhold_history = pd.DataFrame()  # 每日持仓历史
-        self.balance_history = pd.DataFrame()  # 每日资金余额历史
-        self.stock_profit_history = pd.DataFrame()  # 股票实现盈亏历史（不包含浮盈）
+        # 历史记录按列追加，访问或保存时才生成DataFrame
+        self.stockhold_builder = HistoryBuilder()  # 每日持仓历史
+        self.balance_builder = HistoryBuilder()  # 每日资金余额历史
+        self.stock_profit_builder = HistoryBuilder()  # 股票实现盈亏历史（不包含浮盈）
         self.stockhold_record = None
         self.balance_record = None
 
@@ -147,12 +193,9 @@ class AccountSummary:
                     '备注': "",
                 })
         else:  # 从特定日期开始的增量数据分析
-            stockhold_history = AccountSummary.load_stockhold_from_file()
-            # 找到离 start_date 最近的交收日期对应的行索引
-            prev_date_idx = stockhold_history['交收日期'].sub(start_date).idxmax()
-            # 找到离 start_date 最近的交收日期(可以是当天）
-            prev_date = stockhold_history.loc[prev_date_idx]['交收日期']
-            stockhold_data = stockhold_history.loc[stockhold_history['交收日期'] == prev_date]
+            # start_date 之前最近一个交收日期的持仓
+            prev_date = AccountSummary.prev_history_date(start_date)
+            stockhold_data = AccountSummary.load_stockhold_from_file(prev_date, prev_date)
         return pd.DataFrame(stockhold_data)
 
     @staticmethod
@@ -176,119 +219,97 @@ class AccountSummary:
                     '盈亏': 0.0,
                 })
         else:  # 从特定日期开始的增量数据分析
-            balance_history = AccountSummary.load_balance_from_file()
-            # 找到离 start_date 最近的交收日期对应的行索引
-            prev_date_idx = balance_history['交收日期'].sub(start_date).idxmax()
-            # 找到离 start_date 最近的交收日期(可以是当天）
-            prev_date = balance_history.loc[prev_date_idx]['交收日期']
-            balance_data = balance_history.loc[balance_history['交收日期'] == prev_date]
+            # start_date 之前最近一个交收日期的资金余额
+            prev_date = AccountSummary.prev_history_date(start_date)
+            balance_data = AccountSummary.load_balance_from_file(prev_date, prev_date)
         return pd.DataFrame(balance_data)
 
-    # 从 'analyze_summary.xlsx' 文件中加载历史的持仓记录
+    # 账户历史数据库。还没有数据库时，从原来作为数据文件的 'analyze_summary.xlsx' 导入
     @staticmethod
-    def load_stockhold_from_file():
-        if os.path.exists(AccountSummary.ACCOUNT_SUMMARY_FILE):
-            return pd.read_excel(AccountSummary.ACCOUNT_SUMMARY_FILE, sheet_name="股票持仓历史", header=0,
-                             dtype={'证券代码': str})
-        else:
+    def history_db():
+        db = AccountHistoryDB()
+        if not db.exists() and os.path.exists(AccountSummary.ACCOUNT_SUMMARY_FILE):
+            print(f"从{AccountSummary.ACCOUNT_SUMMARY_FILE}导入账户历史数据到{db.db_file}")
+            db.import_excel(AccountSummary.ACCOUNT_SUMMARY_FILE)
+        return db
+
+    # 账户历史中 start_date 之前（不含）最近的交收日期
+    @staticmethod
+    def prev_history_date(start_date):
+        prev_date = AccountSummary.history_db().latest_date('账户余额历史', before_date=start_date)
+        if prev_date is None:
+            raise ValueError(f"账户历史中没有{start_date}之前的记录，无法增量分析，请从头全量分析")
+        return prev_date
+
+    # 从账户历史数据库中加载交收日期在 [start_date, end_date] 之间的持仓记录，没有历史数据时返回None
+    @staticmethod
+    def load_stockhold_from_file(start_date=None, end_date=None):
+        db = AccountSummary.history_db()
+        if not db.exists():
             return None
+        return db.read('股票持仓历史', start_date, end_date)
 
-    # 从 'analyze_summary.xlsx' 文件中加载历史的账户余额记录
+    # 从账户历史数据库中加载交收日期在 [start_date, end_date] 之间的账户余额记录
     @staticmethod
-    def load_balance_from_file():
-        return pd.read_excel(AccountSummary.ACCOUNT_SUMMARY_FILE, sheet_name="账户余额历史", header=0)
+    def load_balance_from_file(start_date=None, end_date=None):
+        return AccountSummary.history_db().read('账户余额历史', start_date, end_date)
 
-    # 从文件中加载每日持股记录和账户数据
+    # 从账户历史数据库中加载每日持股记录和账户数据
     def load_account_summaries(self, start_date=None):
         """
-        Load data from 'analyze_summary.xlsx'.
+        Load data from the account history database.
         If start_date is provided, only load data from that date onwards.
         """
-        stock_holding_records = self.load_stockhold_from_file()
-        account_balance_records = self.load_balance_from_file()
+        stock_holding_records = self.load_stockhold_from_file(start_date)
+        account_balance_records = self.load_balance_from_file(start_date)
+        return stock_holding_records, account_balance_records
 
-        if start_date:
-            stock_holding_records = stock_holding_records[stock_holding_records['交收日期'] >= start_date]
-            account_balance_records = account_balance_records[account_balance_records['交收日期'] >= start_date]
+    @property
+    def stockhold_history(self):
+        return self.stockhold_builder.to_frame()
 
-        return stock_holding_records, account_balance_records
+    @property
+    def balance_history(self):
+        return self.balance_builder.to_frame()
+
+    @property
+    def stock_profit_history(self):
+        return self.stock_profit_builder.to_frame()
 
     def add_to_history(self, new_balance_row, new_holdings):
-        self.balance_history = pd.concat([self.balance_history, new_balance_row], ignore_index=True)
-        self.stockhold_history = pd.concat([self.stockhold_history, new_holdings], ignore_index=True)
+        self.balance_builder.append(new_balance_row)
+        self.stockhold_builder.append(new_holdings)
 
     def add_to_stock_profit_history(self, new_profit_records):
         # 去除掉持股成本为0的，并把持股成本变符号
         new_profit_records = new_profit_records.drop(new_profit_records[new_profit_records['持股成本'] == 0].index)
         new_profit_records['持股成本'] *= -1
-        self.stock_profit_history = pd.concat([self.stock_profit_history, new_profit_records], ignore_index=True)
+        self.stock_profit_builder.append(new_profit_records)
 
     def save_account_history(self, start_date=None):
+        balance_history = self.balance_history
+        stockhold_history = self.stockhold_history
+        stock_profit_history = self.stock_profit_history
         # 个股盈亏数据的重命名
-        if len(self.stock_profit_history)>0:
-            self.stock_profit_history.rename(columns={'持股成本': '实现盈亏'}, inplace=True)
-            self.stock_profit_history = self.stock_profit_history[['交收日期', '账户类型', '证券代码', '证券名称', '持股数量', '实现盈亏']]
-
-        # 创建一个Excel文件
-        if start_date:  # 增量模式
-            with pd.ExcelWriter(AccountSummary.ACCOUNT_SUMMARY_FILE, engine='openpyxl',
-                                mode='a', if_sheet_exists='overlay') as writer:
-                # 将数据写入Excel文件的不同sheet
-                self.append_data_to_sheet(writer, '账户余额历史', self.balance_history, start_date)
-                self.append_data_to_sheet(writer, '股票持仓历史', self.stockhold_history, start_date)
-                self.append_data_to_sheet(writer, '个股盈亏历史', self.stock_profit_history, start_date)
-
-        else:  # 全量从2007年开始分析的模式
-            # 创建一个新的Excel文件
-            with pd.ExcelWriter(AccountSummary.ACCOUNT_SUMMARY_FILE, mode='w', engine='openpyxl') as writer:
-                # 将数据写入Excel文件的不同sheet
-                # Format the numbers uniformly as '###,###,###.##'
-                self.balance_history.to_excel(writer, sheet_name='账户余额历史', index=False)
-                self.stockhold_history.to_excel(writer, sheet_name='股票持仓历史', index=False)
-                self.stock_profit_history.to_excel(writer, sheet_name='个股盈亏历史', index=False)
-
-        self.format_account_summary_file()
-
-    # 设置格式
-    @staticmethod
-    def format_account_summary_file():
-        # 打开已创建的Excel文件设置格式
-        wb = load_workbook(AccountSummary.ACCOUNT_SUMMARY_FILE)
-        # 逐一选择三个不同的sheet并设置格式
-        for sheet_name in ['账户余额历史', '股票持仓历史', '个股盈亏历史']:
-            ws = wb[sheet_name]
-            # 设置日期格式为YYYY/MM/DD
-            for cell in ws['A']:
-                cell.number_format = 'YYYY/MM/DD'
-        # 保存更改后的Excel文件
-        wb.save(AccountSummary.ACCOUNT_SUMMARY_FILE)
-
-    # 在已有的excel文件指定sheet日期之后追加新的增量数据
+        if len(stock_profit_history) > 0:
+            stock_profit_history = stock_profit_history.rename(columns={'持股成本': '实现盈亏'})
+            stock_profit_history = stock_profit_history[['交收日期', '账户类型', '证券代码', '证券名称', '持股数量', '实现盈亏']]
+
+        # 增量模式只替换数据库中start_date之后的记录，全量从2007年开始分析的模式替换全部记录
+        db = self.history_db() if start_date else AccountHistoryDB()
+        db.upsert_range('账户余额历史', start_date, balance_history)
+        db.upsert_range('股票持仓历史', start_date, stockhold_history)
+        db.upsert_range('个股盈亏历史', start_date, stock_profit_history)
+        # 重新生成的记录还没有计算市值
+        db.reset_valued_dates(start_date)
+
+    # 把账户历史数据库导出为Excel报表。需要读出全部历史并重写整个文件，只在需要查看报表时调用，写入历史时不再自动导出
     @staticmethod
-    def append_data_to_sheet(writer, sheet_name, df_new_data, start_date):
-        if len(df_new_data) > 0 :
-            # 确保新数据只有start_date之后的
-            df_new_data = df_new_data[df_new_data['交收日期'] >= start_date]
-            # 加载已有的数据
-            df_old_data = pd.DataFrame(pd.read_excel(AccountSummary.ACCOUNT_SUMMARY_FILE, sheet_name=sheet_name))
-            df_old_data['交收日期'] = pd.to_datetime(df_old_data['交收日期'])
-            # 将数据df_new_data写入excel中的sheet表,从start_date之后的第一个行开始覆盖/追加写：
-            skip_rows = df_old_data[df_old_data['交收日期'] < start_date].shape[0]
-
-            # 计算写入后的总行数
-            old_rows = len(df_old_data) + 1
-            total_rows = skip_rows + len(df_new_data) + 1  # 加1是因为表头
-            # 如果新写入后的行数小于旧表，则需要添加额外的空行占位
-            empty_rows = total_rows - old_rows
-            if empty_rows > 0:
-                # 创建一个新的Dataframe,里面有 empty_rows 行，每行都为空的
-                empty_df = pd.DataFrame(index=range(empty_rows), columns=df_new_data.columns)
-                df_new_data = pd.concat([df_new_data, empty_df])
-                print(f"新数据比旧数据少，需要为{sheet_name} 补充{empty_rows}行空行")
-
-            df_new_data.to_excel(writer, sheet_name=sheet_name, startrow=skip_rows + 1, index=False, header=False)
-        else:
-            print(f"没有数据需要写入{sheet_name}，跳过")
+    def export_account_summary_file():
+        db = AccountHistoryDB()
+        # 每张历史表一个sheet，交收日期显示为YYYY/MM/DD
+        export_report(AccountSummary.ACCOUNT_SUMMARY_FILE,
+                      [ReportSheet(sheet_name, db.read(sheet_name)) for sheet_name in AccountSummary.HISTORY_SHEETS])
 
 
 # Example usage
@@ -1,8 +1,11 @@
+import hashlib
+import os
 import time
 from datetime import datetime
 from datetime import timedelta
-from io import StringIO
+from io import BytesIO, StringIO
 
+import numpy as np
 import pandas as pd
 from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
@@ -12,6 +15,8 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as expect_conditions
 from selenium.webdriver.support.ui import WebDriverWait
 
+from ledgerSnapshot import LedgerSnapshotStore
+
 GX_WEB_URL = "https://trade2.guosen.com.cn/trade/views/index.html#/stk/zjlscx"
 CHROMEDRIVER_EXE = "C:/standalone tools/webdrivers/chromedriver.exe"
 CHECKPOINT_FILE = "stock/crawler_last_completed_date.txt"
@@ -20,21 +25,227 @@ CHECKPOINT_FILE = "stock/crawler_last_completed_date.txt"
 class StockTransHistory:
     TRANSACTION_ALL_DATA_CSV = 'stock/stock-transaction-all-data.csv'
     DATACRAWLER_RESULT_CSV = 'stock/guoxin_datacrawler.csv'
+    # CSV的带类型二进制镜像（一个目录，每个文件是CSV中连续的一段流水）及其对应的CSV版本（修改时间、大小和内容哈希）
+    TRANSACTION_CACHE_DIR = 'stock/stock-transaction-all-data-parquet'
+    TRANSACTION_CACHE_META = 'stock/stock-transaction-all-data.meta.pkl'
+    LEGACY_CACHE_FILE = 'stock/stock-transaction-all-data.parquet'  # 较早版本的单文件镜像，重新生成镜像时删除
+    CATEGORY_COLUMNS = ['摘要', '货币代码', '证券代码']
+    # 镜像按交收日期排序，分成小的行组，按日期过滤时可以根据每个行组的日期范围跳过不需要的行组
+    CACHE_ROW_GROUP_SIZE = 2000
+    CACHE_VERSION = 4  # 镜像格式的版本，格式变了以后旧的镜像会重新生成
 
     def __init__(self):
         pass
 
+    SPLIT_COLUMNS = ['证券名称', '证券代码']  # 从'交易证券'拆分出来的列，只保存在二进制镜像中，不写回CSV
+
+    # 加载交易流水。从列式的二进制镜像读取，只读取交收日期 >= start_date 的数据；
+    # CSV文件更新过（修改时间和内容哈希都变了）时先更新镜像
     @classmethod
     def load_stock_transactions(cls, start_date=None):
-        # 读取CSV文件
-        data = pd.read_csv(cls.TRANSACTION_ALL_DATA_CSV, encoding='GBK')
+        cls.refresh_transaction_cache()
+        filters = [('交收日期', '>=', pd.to_datetime(start_date))] if start_date else None
+        return pd.read_parquet(cls.TRANSACTION_CACHE_DIR, filters=filters)
+
+    @classmethod
+    def refresh_transaction_cache(cls):
+        """
+        让二进制镜像与CSV一致：
+        CSV只在末尾追加了流水（原来的内容一字节不差，追加的流水不早于镜像中的最后日期）时，只解析追加的部分，写成镜像中的一个新文件；
+        否则重新生成整个镜像，已经在镜像中出现过的'交易证券'直接沿用原来的拆分结果
+        """
+        mtime = os.path.getmtime(cls.TRANSACTION_ALL_DATA_CSV)
+        meta = pd.read_pickle(cls.TRANSACTION_CACHE_META) \
+            if os.path.exists(cls.TRANSACTION_CACHE_META) and os.path.exists(cls.TRANSACTION_CACHE_DIR) else None
+        if meta is not None and meta.get('version') != cls.CACHE_VERSION:
+            meta = None
+        if meta is not None and meta['mtime'] == mtime:
+            return
+        size = os.path.getsize(cls.TRANSACTION_ALL_DATA_CSV)
+        digest, prefix_digest = cls.file_digest(cls.TRANSACTION_ALL_DATA_CSV,
+                                                meta['size'] if meta is not None and size > meta['size'] else None)
+        if meta is not None and meta['sha1'] == digest:
+            # 只是修改时间变了而内容没变时，不需要更新镜像
+            meta['mtime'] = mtime
+            pd.to_pickle(meta, cls.TRANSACTION_CACHE_META)
+            return
+
+        data = None
+        if meta is not None and prefix_digest == meta['sha1']:
+            data = cls.read_transactions_csv(cls.TRANSACTION_ALL_DATA_CSV, offset=meta['size'],
+                                             known_splits=cls.load_known_splits(meta))
+            if len(data) > 0 and data['交收日期'].min() < meta['last_date']:
+                data = None  # 追加的流水早于镜像中的最后日期，镜像需要重新排序
+        if data is not None:
+            print(f"{cls.TRANSACTION_ALL_DATA_CSV}追加了{len(data)}条流水，追加到二进制镜像")
+            part = meta['parts']
+        else:
+            print(f"重新生成{cls.TRANSACTION_ALL_DATA_CSV}的二进制镜像")
+            data = cls.read_transactions_csv(cls.TRANSACTION_ALL_DATA_CSV,
+                                             known_splits=cls.load_known_splits(meta))
+            cls.clear_transaction_cache()
+            part = 0
+        last_date = meta['last_date'] if part > 0 else pd.NaT
+        fingerprints = meta['fingerprints'] if part > 0 else cls.empty_fingerprints()
+        # 同一天的流水保持CSV中的先后顺序
+        data = data.sort_values('交收日期', kind='stable').reset_index(drop=True)
+        # 重新生成时即使没有流水也写一个文件，镜像目录总是可以读取
+        if len(data) > 0 or part == 0:
+            cls.write_cache_part(data, part)
+            part += 1
+        if len(data) > 0:
+            last_date = data['交收日期'].max() if pd.isna(last_date) else max(last_date, data['交收日期'].max())
+            fingerprints = cls.extend_fingerprints(fingerprints, data)
+        pd.to_pickle({'version': cls.CACHE_VERSION, 'mtime': mtime, 'size': size, 'sha1': digest, 'parts': part,
+                      'last_date': last_date, 'fingerprints': fingerprints}, cls.TRANSACTION_CACHE_META)
+
+    # 镜像中每个交收日期为止（含）的流水指纹：行数和按行的先后加权的行内容哈希之和。
+    # 快照保存当天的指纹，恢复时与镜像当前的指纹比较，手工修改了快照之前的流水时快照不再使用
+    @classmethod
+    def load_fingerprints(cls):
+        cls.refresh_transaction_cache()
+        return pd.read_pickle(cls.TRANSACTION_CACHE_META)['fingerprints']
+
+    @staticmethod
+    def empty_fingerprints():
+        return pd.DataFrame({'行数': pd.Series(dtype='int64'), '哈希': pd.Series(dtype='uint64')},
+                            index=pd.DatetimeIndex([], name='交收日期'))
+
+    # 在指纹表后面接上按交收日期排好序的新流水（新流水不早于指纹表中的最后日期），可以增量计算
+    @classmethod
+    def extend_fingerprints(cls, fingerprints, data):
+        start_rows = int(fingerprints['行数'].iloc[-1]) if len(fingerprints) > 0 else 0
+        start_hash = fingerprints['哈希'].iloc[-1] if len(fingerprints) > 0 else np.uint64(0)
+        # 只用CSV中的原始列计算哈希，拆分出来的列由它们决定
+        row_hashes = pd.util.hash_pandas_object(data.drop(columns=cls.SPLIT_COLUMNS), index=False).to_numpy()
+        positions = np.arange(start_rows + 1, start_rows + len(data) + 1, dtype='uint64')
+        # uint64 的乘法和累加按 2**64 取模
+        cumulative = pd.DataFrame({'交收日期': data['交收日期'],
+                                   '行数': np.arange(start_rows + 1, start_rows + len(data) + 1, dtype='int64'),
+                                   '哈希': start_hash + np.cumsum(row_hashes * positions, dtype='uint64')})
+        new_fingerprints = cumulative.groupby('交收日期').last()
+        # 新流水和原来最后一天相同日期时，这一天的指纹被覆盖
+        fingerprints = fingerprints[~fingerprints.index.isin(new_fingerprints.index)]
+        return pd.concat([fingerprints, new_fingerprints]).astype({'行数': 'int64', '哈希': 'uint64'})
+
+    # 镜像中的一段流水写成一个文件
+    @classmethod
+    def write_cache_part(cls, data, part):
+        data = data.copy()
+        for col in cls.CATEGORY_COLUMNS:
+            data[col] = data[col].astype('category')
+        os.makedirs(cls.TRANSACTION_CACHE_DIR, exist_ok=True)
+        path = os.path.join(cls.TRANSACTION_CACHE_DIR, f'part-{part:05d}.parquet')
+        data.to_parquet(path + '.tmp', index=False, row_group_size=cls.CACHE_ROW_GROUP_SIZE)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def clear_transaction_cache(cls):
+        if os.path.exists(cls.TRANSACTION_CACHE_DIR):
+            for file_name in os.listdir(cls.TRANSACTION_CACHE_DIR):
+                os.remove(os.path.join(cls.TRANSACTION_CACHE_DIR, file_name))
+        if os.path.exists(cls.LEGACY_CACHE_FILE):
+            os.remove(cls.LEGACY_CACHE_FILE)
+
+    # 镜像中已有的 '交易证券' -> 证券名称、证券代码 的拆分结果，没有可用的镜像时返回None
+    @classmethod
+    def load_known_splits(cls, meta):
+        if meta is None or meta['parts'] == 0:
+            return None
+        splits = pd.read_parquet(cls.TRANSACTION_CACHE_DIR, columns=['交易证券'] + cls.SPLIT_COLUMNS)
+        splits = splits.astype(object).dropna(subset=['交易证券']).drop_duplicates('交易证券')
+        return splits.set_index('交易证券')
+
+    @staticmethod
+    def file_digest(file, prefix_size=None):
+        """
+        文件内容的哈希，同时返回前 prefix_size 个字节的哈希（用于判断文件是否只是在末尾追加了内容），
+        prefix_size为None时第二个返回值为None
+        """
+        sha1 = hashlib.sha1()
+        prefix_digest = None
+        with open(file, 'rb') as f:
+            if prefix_size is not None:
+                prefix = f.read(prefix_size)
+                sha1.update(prefix)
+                # 原来的内容必须以换行结束，追加的部分才是完整的行
+                prefix_digest = sha1.hexdigest() if prefix.endswith(b'\n') else None
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest(), prefix_digest
+
+    # 解析CSV格式的交易流水，在内存中拆分出证券名称和证券代码（CSV文件本身不做任何修改）。
+    # offset不为None时只解析从这个字节位置开始的行（列名仍取自文件的第一行）
+    @classmethod
+    def read_transactions_csv(cls, csv_file=None, offset=None, known_splits=None):
+        csv_file = csv_file or cls.TRANSACTION_ALL_DATA_CSV
+        if offset is None:
+            source = csv_file
+        else:
+            with open(csv_file, 'rb') as f:
+                header = f.readline()
+                f.seek(offset)
+                source = BytesIO(header + f.read())
+        data = pd.read_csv(source, encoding='GBK', dtype={'证券名称': str, '证券代码': str})
+        cls.fill_split_columns(data, known_splits)
         if not pd.api.types.is_datetime64_any_dtype(data['交收日期']):
             # 将“交收日期”列转换为日期类型
             data['交收日期'] = pd.to_datetime(data['交收日期'])  # , format='%Y%m%d')
-        if start_date:
-            data = data[data['交收日期'] >= pd.to_datetime(start_date)]
         return data
 
+    # 对还没有拆分的行拆分出证券名称和证券代码（CSV中已经有拆分结果的行保持不变）。
+    # known_splits 中已有的'交易证券'直接使用其拆分结果，其余的按不同的'交易证券'各拆分一次
+    @classmethod
+    def fill_split_columns(cls, data, known_splits=None):
+        for col in cls.SPLIT_COLUMNS:
+            if col not in data.columns:
+                data[col] = pd.Series(index=data.index, dtype=object)
+        missing = data['证券代码'].isna() & data['交易证券'].notna()
+        if missing.any():
+            securities = data.loc[missing, '交易证券'].astype(object)
+            unique_securities = pd.Series(securities.unique(), dtype=object)
+            if known_splits is not None:
+                unique_securities = unique_securities[~unique_securities.isin(known_splits.index)]
+            splits = cls.split_securities(unique_securities).set_index(unique_securities)
+            if known_splits is not None:
+                splits = pd.concat([known_splits, splits])
+            data.loc[missing, cls.SPLIT_COLUMNS] = splits.reindex(securities)[cls.SPLIT_COLUMNS].to_numpy()
+        # 空的证券名称在CSV里读回来是NaN
+        data['证券名称'] = data['证券名称'].where(data['交易证券'].isna(), data['证券名称'].fillna(''))
+
+    @staticmethod
+    def split_securities(securities):
+        """
+        将'交易证券'列向量化地拆分为证券名称和证券代码
+
+        Args:
+            securities (Series): '交易证券'列
+
+        Returns:
+            DataFrame: ['证券名称', '证券代码']两列，index与securities相同。规则：
+                '-123'这样'-'加数字的拆分为'-'和补足6位的代码；
+                按空白拆分，最后一部分是证券代码，前面的部分（名称里可能有空格）用' '连接为证券名称；
+                只有一个数字部分时，拆分为该数字和'-'
+        """
+        securities = securities.astype(object)
+        normalized = securities.str.strip().str.replace(r'\s+', ' ', regex=True)
+        parts = normalized.str.extract(r'^(?:(?P<name>.*) )?(?P<code>\S+)$')
+        names = parts['name'].fillna('')
+        codes = parts['code']
+
+        # 只有一个数字部分的，拆分为数字和'-'
+        single_number = parts['name'].isna() & codes.str.fullmatch(r'\d+').fillna(False).astype(bool)
+        names = names.mask(single_number, codes)
+        codes = codes.mask(single_number, '-')
+
+        # 以'-'开头且后面是数字的，拆分为'-'和补足6位的数字
+        dash_number = securities.str.extract(r'^-(\d+)$')[0]
+        is_dash_number = dash_number.notna()
+        names = names.mask(is_dash_number, '-')
+        codes = codes.mask(is_dash_number, dash_number.str.zfill(6))
+
+        return pd.DataFrame({'证券名称': names, '证券代码': codes}, index=securities.index)
+
     @classmethod
     def generate_month_ranges(cls, begin_year, end_year, end_month=None, continue_date=None):
         ranges = []
@@ -184,9 +395,8 @@ class StockTransHistory:
             new_data = pd.read_csv(cls.DATACRAWLER_RESULT_CSV, encoding='GBK')
             # 将“交收日期”列转换为日期类型
             new_data['交收日期'] = pd.to_datetime(new_data['交收日期'], format='%Y%m%d')
-
-            # 读取 TRANSACTION_ALL_DATA_CSV 文件
-            all_data = cls.load_stock_transactions()
+            # 读取 TRANSACTION_ALL_DATA_CSV 文件，拆分出来的列只在二进制镜像中，不保存到CSV
+            all_data = cls.load_stock_transactions().drop(columns=cls.SPLIT_COLUMNS)
 
             old_data_end_date = all_data['交收日期'].max()
             new_data_begin_date = new_data['交收日期'].min()
@@ -197,11 +407,20 @@ class StockTransHistory:
                 all_data = all_data[all_data['交收日期'] <= new_data_begin_date]
                 print("重叠日期记录已删除，以防止重复")
 
-            # 将新数据追加到 all_data 中
-            all_data = pd.concat([all_data, new_data], ignore_index=True)
+            # 新数据开始日期之后的账本快照已经过时
+            LedgerSnapshotStore().discard_from(new_data_begin_date)
+
+            csv_columns = list(pd.read_csv(cls.TRANSACTION_ALL_DATA_CSV, encoding='GBK', nrows=0).columns)
+            if new_data_begin_date >= old_data_end_date and set(new_data.columns) <= set(csv_columns):
+                # 没有重叠时只在CSV末尾追加新数据，原来的内容不变，二进制镜像也只需要追加这些新数据
+                new_data.reindex(columns=csv_columns).to_csv(cls.TRANSACTION_ALL_DATA_CSV, mode='a', header=False,
+                                                             index=False, encoding='GBK')
+            else:
+                # 将新数据追加到 all_data 中
+                all_data = pd.concat([all_data, new_data], ignore_index=True)
 
-            # 保存更新后的数据到 TRANSACTION_ALL_DATA_CSV 文件
-            all_data.to_csv(cls.TRANSACTION_ALL_DATA_CSV, index=False, encoding='GBK')
+                # 保存更新后的数据到 TRANSACTION_ALL_DATA_CSV 文件
+                all_data.to_csv(cls.TRANSACTION_ALL_DATA_CSV, index=False, encoding='GBK')
             print(f"Data appended to {cls.TRANSACTION_ALL_DATA_CSV}")
         except FileNotFoundError:
             print(f"Error: {cls.DATACRAWLER_RESULT_CSV} file not found.")
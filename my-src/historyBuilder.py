@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+# 按列追加的历史记录构建器，用来代替每天 pd.concat 一次不断变长的历史DataFrame
+# 每次 append 只把各列的数组放进列表；每追加 chunk_size 次，把最近这一批数组合并成一个块，
+# 这样追加的代价与已有的历史长度无关，最后 to_frame 时每列只做一次合并
+class HistoryBuilder:
+    def __init__(self, chunk_size=256):
+        self.chunk_size = chunk_size
+        self.columns = []  # 列名，按第一次出现的顺序
+        self.buffers = {}  # 列名 -> 数组列表：前面是已合并的块，后面是还没有合并的数组
+        self.chunk_starts = {}  # 列名 -> buffers 中第一个还没有合并的数组的位置
+        self.rows = 0
+        self.pending_appends = 0
+        self._frame = None  # to_frame 的结果缓存，追加新数据后失效
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, frame):
+        if frame is None or len(frame) == 0:
+            return
+        n = len(frame)
+        for col in frame.columns:
+            if col not in self.buffers:
+                # 新出现的列，之前的行用空值补齐
+                self.columns.append(col)
+                self.buffers[col] = [np.full(self.rows, np.nan, dtype=object)] if self.rows > 0 else []
+                self.chunk_starts[col] = len(self.buffers[col])
+            self.buffers[col].append(frame[col].to_numpy())
+        for col in self.columns:
+            if col not in frame.columns:
+                self.buffers[col].append(np.full(n, np.nan, dtype=object))
+        self.rows += n
+        self.pending_appends += 1
+        self._frame = None
+        if self.pending_appends >= self.chunk_size:
+            self._merge_pending()
+
+    # 把每列还没有合并的数组合并成一个块
+    def _merge_pending(self):
+        for col in self.columns:
+            start = self.chunk_starts[col]
+            arrays = self.buffers[col]
+            if len(arrays) - start > 1:
+                arrays[start:] = [concat_arrays(arrays[start:])]
+            self.chunk_starts[col] = len(arrays)
+        self.pending_appends = 0
+
+    # 生成DataFrame（结果会缓存，没有新追加时重复调用不会重新合并）
+    def to_frame(self):
+        if self._frame is None:
+            if self.rows == 0:
+                self._frame = pd.DataFrame()
+            else:
+                self._frame = pd.DataFrame({col: concat_arrays(self.buffers[col]) for col in self.columns})
+                self._frame = self._frame.infer_objects()
+        return self._frame
+
+
+# 合并一列的多个数组。类型一致时直接用numpy合并，否则（例如日期列与补齐的空值）交给pandas处理类型
+def concat_arrays(arrays):
+    if len({array.dtype for array in arrays}) == 1:
+        return np.concatenate(arrays)
+    return pd.concat([pd.Series(array) for array in arrays], ignore_index=True).to_numpy()
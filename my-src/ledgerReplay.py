@@ -0,0 +1,289 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from positionLedger import PositionLedger
+
+# 普通账户和融资账户之间划转股份时，同一天同一只股票成对出现的摘要
+TRANSFER_PAIRS = [('担保品划入', '股份转出'), ('股份转入', '担保品划出')]
+# 成对划转时，转出方的摘要 -> 转入的账户
+TRANSFER_TARGETS = {'股份转出': '国信融资账户', '担保品划出': '国信账户'}
+
+# 每笔流水对持仓的操作
+HOLDING_NONE = ''  # 不影响持仓
+HOLDING_UPDATE = '更新'  # 更新本账户的持仓
+HOLDING_TRANSFER = '划转'  # 成对划转的转出方：按转出时的持仓成本，把股份连同成本划转到对方账户
+
+
+# 按账户分开回放交易流水。
+# 三个账户（国信账户、国信融资账户、国信B股）之间只通过成对的股份划转相互影响，
+# 先找出这些划转并算出划转的成本（只需要回放涉及划转的股票），把它们变成对方账户上的一笔持仓更新，
+# 之后每个账户的持仓和资金余额就可以各自独立回放（parallel=True 时每个账户一个进程），最后按持仓建立的先后顺序合并
+def prepare_replay_rows(data, trade_dates):
+    """
+    整理需要回放的流水（已经过 SummaryClassifier.annotate）：只保留交易日内的流水，按原来逐日、逐只股票处理的顺序排好，
+    并算好每笔流水的成交数量变动、资金变动、银行流水以及对持仓的操作
+
+    :return: 排好序的流水，'顺序'列为回放顺序 0 ~ n-1
+    """
+    # 证券代码为空的流水不会被处理（按证券代码分组时被丢掉）
+    rows = data[data['交收日期'].isin(trade_dates) & data['证券代码'].notna()].reset_index(drop=True)
+    # 回放顺序：按交收日期，同一天内按证券代码第一次出现的先后，同一只股票保持原来的顺序
+    position = pd.Series(np.arange(len(rows)))
+    day_code = [rows['交收日期'], rows['证券代码']]
+    first_position = position.groupby(day_code, observed=True).transform('min')
+    order = np.lexsort((position.to_numpy(), first_position.to_numpy(), rows['交收日期'].to_numpy()))
+    rows = rows.iloc[order].reset_index(drop=True)
+    rows['顺序'] = np.arange(len(rows))
+
+    rows['成交数量变动'] = rows['成交数量'].abs() * rows['成交数量标志']
+    rows['资金变动'] = rows['发生金额'] * rows['发生金额标志']
+    rows['银行流水'] = rows['发生金额'] * rows['银行标志']
+
+    # 同一天同一只股票的摘要里同时有成对的划转摘要
+    day_code = [rows['交收日期'], rows['证券代码']]
+    summaries = rows['摘要'].astype(object)
+    transaction_pair = pd.Series(False, index=rows.index)
+    for pair in TRANSFER_PAIRS:
+        has_pair = pd.Series(True, index=rows.index)
+        for summary in pair:
+            has_pair &= (summaries == summary).groupby(day_code, observed=True).transform('any')
+        transaction_pair |= has_pair
+
+    # 只有数字代码、名称不是'-'的才是股票持仓
+    holding = rows['证券代码'].astype(str).str.isdigit() & (rows['证券名称'] != '-')
+    # 成对时'担保品划入'、'股份转入'在转出方处理；不成对的'股份转出'、'股份转入'相当于临时冻结股票，都忽略
+    ignored = (transaction_pair & summaries.isin(['担保品划入', '股份转入'])) | \
+              (~transaction_pair & summaries.isin(['股份转出', '股份转入']))
+    transfer = holding & transaction_pair & summaries.isin(list(TRANSFER_TARGETS))
+    update = holding & ~ignored & ~transfer
+    rows['持仓操作'] = np.select([transfer, update], [HOLDING_TRANSFER, HOLDING_UPDATE], default=HOLDING_NONE)
+    # 融资借款 和融资还款这种只有发生金额没有成交价格的在持股成本计算时要忽略
+    rows['持股成本变动'] = rows['资金变动'].astype(object).mask(rows['融资流水'] | rows['冻结流水'], 0)
+    return rows
+
+
+def resolve_transfer_costs(rows, init_records):
+    """
+    按回放顺序只回放涉及成对划转的股票的持仓，算出每笔划转转出时的成本
+
+    :param rows: prepare_replay_rows 整理好的流水
+    :param init_records: 回放开始时的持仓记录（Position.to_record 的格式）
+    :return: {回放顺序: 划转成本}
+    """
+    transfer_codes = set(rows.loc[rows['持仓操作'] == HOLDING_TRANSFER, '证券代码'])
+    if not transfer_codes:
+        return {}
+    related = rows[rows['证券代码'].isin(transfer_codes) & (rows['持仓操作'] != HOLDING_NONE)]
+    ledger = PositionLedger.from_records([record for record in init_records if record[2] in transfer_codes])
+    costs = {}
+    current_date = None
+    for row in related[['交收日期', '顺序', '账户类型', '证券代码', '证券名称', '摘要', '持仓操作', '持股成本变动',
+                        '成交数量变动']].itertuples(index=False, name=None):
+        trade_date, order, account_type, stock_code, stock_name, summary, operation, cost, trade_quantity = row
+        # 持股数量为0的持仓在新的交易日开始时被删除
+        if trade_date != current_date:
+            ledger.pop_closed()
+            current_date = trade_date
+        if operation == HOLDING_UPDATE:
+            ledger.update(account_type, stock_code, stock_name, cost, trade_quantity)
+        else:
+            trans_out = ledger.get(account_type, stock_code)
+            if trans_out is None:
+                raise ValueError(f"转入转出错误：{trade_date} 账户{account_type}没有证券{stock_code}（{stock_name}）的持仓，"
+                                 f"无法按持仓成本划转，摘要：{summary}")
+            cost = (abs(trade_quantity) / trans_out.quantity) * trans_out.cost
+            ledger.update(TRANSFER_TARGETS[summary], stock_code, stock_name, -1 * cost, abs(trade_quantity))
+            ledger.update(account_type, stock_code, stock_name, cost, trade_quantity)
+            costs[order] = cost
+    return costs
+
+
+# 生成所有账户的持仓更新 (交收日期, seq, 账户类型, 证券代码, 证券名称, 发生金额, 成交数量)，按seq排序。
+# 划转生成两笔更新：对方账户的转入（seq=2*顺序）在前，本账户的转出（seq=2*顺序+1）在后
+def build_holding_updates(rows, transfer_costs):
+    columns = ['交收日期', 'seq', '账户类型', '证券代码', '证券名称', '发生金额', '成交数量']
+    updates = rows[rows['持仓操作'] == HOLDING_UPDATE]
+    updates = pd.DataFrame({'交收日期': updates['交收日期'], 'seq': updates['顺序'] * 2 + 1,
+                            '账户类型': updates['账户类型'], '证券代码': updates['证券代码'],
+                            '证券名称': updates['证券名称'], '发生金额': updates['持股成本变动'],
+                            '成交数量': updates['成交数量变动']}, columns=columns)
+    transfers = rows[rows['持仓操作'] == HOLDING_TRANSFER]
+    if len(transfers) > 0:
+        costs = transfers['顺序'].map(transfer_costs).astype(object)
+        transfers_in = pd.DataFrame({'交收日期': transfers['交收日期'], 'seq': transfers['顺序'] * 2,
+                                     '账户类型': transfers['摘要'].astype(object).map(TRANSFER_TARGETS),
+                                     '证券代码': transfers['证券代码'], '证券名称': transfers['证券名称'],
+                                     '发生金额': costs * -1, '成交数量': transfers['成交数量变动'].abs()},
+                                    columns=columns)
+        transfers_out = pd.DataFrame({'交收日期': transfers['交收日期'], 'seq': transfers['顺序'] * 2 + 1,
+                                      '账户类型': transfers['账户类型'], '证券代码': transfers['证券代码'],
+                                      '证券名称': transfers['证券名称'], '发生金额': costs,
+                                      '成交数量': transfers['成交数量变动']}, columns=columns)
+        updates = pd.concat([updates, transfers_in, transfers_out], ignore_index=True)
+    updates['证券代码'] = updates['证券代码'].astype(object)
+    return updates.sort_values('seq', kind='stable').reset_index(drop=True)
+
+
+def group_by_date(records):
+    groups = {}
+    for record in records:
+        groups.setdefault(record[0], []).append(record)
+    return groups
+
+
+def replay_account(task):
+    """
+    回放一个账户：每个交易日先删除已清仓的持仓，再依次应用当天的持仓更新和资金流水。
+    资金余额的校验（记录账户余额、校验差异）由 reconcile_balances 对所有账户、所有日期一次算好
+
+    :param task: replay_accounts 生成的任务字典
+    :return: {'balance': 每日的资金余额(dict，没有资金余额记录的账户为None), 'holdings': 每日的持仓记录,
+              'closed': 每日开始时删除的已清仓持仓记录}，每个列表与 trade_dates 一一对应
+    """
+    ledger = PositionLedger.from_records(task['positions'])
+    balance = dict(task['balance']) if task['balance'] is not None else None
+    updates_by_date = group_by_date(task['updates'])
+    flows_by_date = group_by_date(task['flows'])
+    result = {'balance': [], 'holdings': [], 'closed': []}
+    for trade_date in task['trade_dates']:
+        result['closed'].append([position.to_record() for position in ledger.pop_closed()])
+        for _, seq, account_type, stock_code, stock_name, amount, quantity in updates_by_date.get(trade_date, ()):
+            ledger.update(account_type, stock_code, stock_name, amount, quantity, seq)
+        result['holdings'].append(ledger.to_records())
+        if balance is None:
+            result['balance'].append(None)
+            continue
+
+        balance['交收日期'] = trade_date
+        for _, summary, trade_amount, bank_flow_amount, is_rongzi, is_frozen in flows_by_date.get(trade_date, ()):
+            balance['资金余额'] += trade_amount
+            balance['累计净转入资金'] += bank_flow_amount
+            # 计算当天融资账户借款余额
+            if is_rongzi:
+                balance['融资借款'] += trade_amount
+                # 因为融入方初始交易 和 融入购回减资金 结对时会多还资金（融资利息），所以如果为负了，则置为0
+                if summary == '融入购回减资金' and balance['融资借款'] < 0:
+                    balance['融资借款'] = 0
+            # 计算当天被冻结的资金余额
+            if is_frozen:
+                balance['冻结资金'] += trade_amount
+
+        # 任何账户当天有交易记录时，将融资余额小于0.001的值设置为0（会影响之后的累加，所以在回放中处理）
+        if trade_date in task['active_dates']:
+            if abs(balance['融资借款']) < 0.001:
+                balance['融资借款'] = 0
+        result['balance'].append(dict(balance))
+    return result
+
+
+def replay_accounts(init_records, init_balance, rows, trade_dates, parallel=False):
+    """
+    按账户分开回放
+
+    :param init_records: 回放开始时的持仓记录（Position.to_record 的格式）
+    :param init_balance: 回放开始时各账户的资金余额DataFrame
+    :param rows: prepare_replay_rows 整理好的流水
+    :param trade_dates: 需要回放的交易日
+    :param parallel: 为True时每个账户在单独的进程中回放
+    :return: 各账户的 replay_account 结果（资金余额中的账户按原来的顺序在前）
+    """
+    updates = build_holding_updates(rows, resolve_transfer_costs(rows, init_records))
+    flow_columns = ['交收日期', '摘要', '资金变动', '银行流水', '融资流水', '冻结流水']
+    flows = rows[flow_columns].astype({'摘要': object})
+
+    balance_accounts = list(init_balance['账户类型'])
+    unknown_accounts = set(rows['账户类型']) - set(balance_accounts)
+    if unknown_accounts:
+        raise ValueError(f"交易流水中的账户{sorted(unknown_accounts)}没有资金余额记录")
+    position_accounts = {record[1] for record in init_records} | set(updates['账户类型'])
+    accounts = balance_accounts + sorted(position_accounts - set(balance_accounts))
+
+    trade_dates = list(trade_dates)
+    active_dates = set(rows['交收日期'])
+    balance_records = init_balance.to_dict('records')
+    tasks = []
+    for account_type in accounts:
+        account_updates = updates[updates['账户类型'] == account_type]
+        account_flows = flows[rows['账户类型'] == account_type]
+        tasks.append({
+            'positions': [record for record in init_records if record[1] == account_type],
+            'balance': balance_records[balance_accounts.index(account_type)]
+            if account_type in balance_accounts else None,
+            'updates': list(account_updates.itertuples(index=False, name=None)),
+            'flows': list(account_flows.itertuples(index=False, name=None)),
+            'trade_dates': trade_dates,
+            'active_dates': active_dates,
+        })
+    if not tasks:
+        return []
+    if parallel:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            results = list(executor.map(replay_account, tasks))
+    else:
+        results = [replay_account(task) for task in tasks]
+    return results
+
+
+def reconcile_balances(rows, init_balance, trade_dates):
+    """
+    对所有账户、所有交易日一次性做资金余额校验：每个账户每个有流水的交易日，
+    用日终的资金余额（回放开始时的余额加上资金变动的累计和）与当天流水里记录的资金余额中最接近的一个比较。
+    没有流水的日子沿用上一次的校验结果；任何账户有流水的日子，校验差异小于0.001的设置为0
+
+    :param rows: prepare_replay_rows 整理好的流水
+    :param init_balance: 回放开始时各账户的资金余额DataFrame
+    :param trade_dates: 需要回放的交易日
+    :return: (checked, breaks)
+        checked: 形状为 (交易日数, 账户数, 2) 的数组，最后一维是 [记录账户余额, 校验差异]，账户顺序同 init_balance；
+        breaks: 校验差异不为0的 (交收日期, 账户类型) 的报告
+    """
+    accounts = list(init_balance['账户类型'])
+    init_balance = init_balance.set_index('账户类型')
+    flows = rows.loc[rows['账户类型'].isin(accounts), ['交收日期', '账户类型', '资金变动', '资金余额']]
+    flows = flows.reset_index(drop=True)
+
+    # 每笔流水之后的资金余额，逐笔累加（与回放时的加法顺序相同，结果完全一致）
+    running_balance = np.empty(len(flows))
+    amounts = flows['资金变动'].to_numpy(dtype=float)
+    for account_type, index in flows.groupby('账户类型').indices.items():
+        start = float(init_balance.loc[account_type, '资金余额'])
+        running_balance[index] = np.cumsum(np.concatenate([[start], amounts[index]]))[1:]
+    day_account = [flows['交收日期'], flows['账户类型']]
+    flows['日终余额'] = pd.Series(running_balance).groupby(day_account).transform('last')
+    # 当天记录的资金余额中与日终余额最接近的一个（相同时取第一个）
+    flows['差距'] = (flows['资金余额'] - flows['日终余额']).abs()
+    closest = flows.loc[flows.groupby(day_account, sort=False)['差距'].idxmin()]
+    checked = pd.DataFrame({
+        '交收日期': closest['交收日期'].to_numpy(),
+        '账户类型': closest['账户类型'].to_numpy(),
+        '资金余额': closest['日终余额'].to_numpy(),
+        '记录账户余额': closest['资金余额'].to_numpy(),
+        '校验差异': (closest['日终余额'] - closest['资金余额']).to_numpy(),
+        '流水笔数': flows.groupby(day_account, sort=False).size().to_numpy(),
+    })
+    checked.loc[checked['校验差异'].abs() < 0.001, '校验差异'] = 0
+    breaks = checked[checked['校验差异'] != 0].reset_index(drop=True)
+
+    # 展开到每个交易日：先沿用上一次的校验结果，回放开始前的值用初始余额里的
+    grid = pd.MultiIndex.from_product([pd.DatetimeIndex(trade_dates), accounts], names=['交收日期', '账户类型'])
+    daily = checked.set_index(['交收日期', '账户类型'])[['记录账户余额', '校验差异']].reindex(grid)
+    daily = daily.groupby(level='账户类型', sort=False).ffill()
+    initial = init_balance.loc[accounts, ['记录账户余额', '校验差异']].to_numpy(dtype=float)
+    checked_values = np.array(daily.to_numpy(dtype=float)).reshape(len(trade_dates), len(accounts), 2)
+    not_checked = np.isnan(checked_values)
+    initial = np.broadcast_to(initial, checked_values.shape)
+    checked_values[not_checked] = initial[not_checked]
+    # 第一个有流水的交易日起，初始的校验差异也按0.001设置为0
+    if len(rows) > 0:
+        after_first_active = pd.DatetimeIndex(trade_dates) >= rows['交收日期'].min()
+        diff = checked_values[:, :, 1]
+        diff[after_first_active[:, None] & (np.abs(diff) < 0.001)] = 0
+    return checked_values, breaks
+
+
+# 把各账户某一天的持仓记录按持仓建立的先后顺序合并
+def merge_records(account_records):
+    return list(heapq.merge(*account_records, key=lambda record: record[0]))
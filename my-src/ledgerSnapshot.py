@@ -0,0 +1,77 @@
+import os
+
+import pandas as pd
+
+LEDGER_SNAPSHOT_DIR = 'stock/ledger_snapshots'  # analyze_transactions 的账本状态快照
+SNAPSHOT_SUFFIX = '.pkl'
+SNAPSHOT_VERSION = 3  # 快照格式的版本，格式变了以后旧的快照不再使用
+
+
+# 账本状态快照：某个交易日日终的持仓（数量、成本）、各账户资金余额（含融资借款、冻结资金）以及每只股票的累计盈亏。
+# 每次分析时在每个月的最后一个交易日和分析结束时各保存一份，文件名为 <交收日期YYYYMMDD>.pkl；
+# 增量分析时从最近的一份快照恢复状态，只需要回放快照之后的交易流水。
+# 快照同时记录保存时到这一天为止的交易流水指纹（StockTransHistory.load_fingerprints），
+# 恢复时指纹对不上（快照之前的流水被手工修改过）的快照被删除
+class LedgerSnapshotStore:
+    def __init__(self, snapshot_dir=LEDGER_SNAPSHOT_DIR):
+        self.snapshot_dir = snapshot_dir
+
+    def snapshot_path(self, trade_date):
+        return os.path.join(self.snapshot_dir, f"{pd.Timestamp(trade_date).strftime('%Y%m%d')}{SNAPSHOT_SUFFIX}")
+
+    # 已有快照的日期（升序）
+    def list_dates(self):
+        if not os.path.exists(self.snapshot_dir):
+            return []
+        return sorted(pd.to_datetime(file_name[:-len(SNAPSHOT_SUFFIX)], format='%Y%m%d')
+                      for file_name in os.listdir(self.snapshot_dir) if file_name.endswith(SNAPSHOT_SUFFIX))
+
+    def latest_date(self):
+        dates = self.list_dates()
+        return dates[-1] if dates else None
+
+    def save(self, trade_date, holdings_df, balance_df, stock_profits, fingerprints):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        snapshot = {
+            '版本': SNAPSHOT_VERSION,
+            '交收日期': pd.Timestamp(trade_date),
+            '流水指纹': self.fingerprint_at(fingerprints, trade_date),
+            '持仓': holdings_df.reset_index(drop=True),
+            '资金余额': balance_df.reset_index(drop=True),
+            '个股盈亏': stock_profits,
+        }
+        # 先写临时文件再改名，避免中途退出留下不完整的快照
+        path = self.snapshot_path(trade_date)
+        pd.to_pickle(snapshot, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    # 读取日期在before_date之前（不含）的最近一份有效快照，没有时返回None。
+    # 与当前交易流水的指纹对不上的快照及其之后的快照都被删除，再尝试更早的快照
+    def load_before(self, before_date, fingerprints):
+        for date in reversed([date for date in self.list_dates() if date < pd.Timestamp(before_date)]):
+            snapshot = pd.read_pickle(self.snapshot_path(date))
+            if snapshot.get('版本') != SNAPSHOT_VERSION:
+                print(f"{date.strftime('%Y-%m-%d')}的账本快照格式已过时，不使用快照")
+                return None
+            if snapshot['流水指纹'] != self.fingerprint_at(fingerprints, date):
+                print(f"{date.strftime('%Y-%m-%d')}之前的交易流水在保存快照后被修改过，删除这一天及之后的快照")
+                self.discard_from(date)
+                continue
+            print(f"从{date.strftime('%Y-%m-%d')}的账本快照恢复状态")
+            return snapshot
+        return None
+
+    # 交易流水到trade_date为止（含）的指纹 (行数, 哈希)
+    @staticmethod
+    def fingerprint_at(fingerprints, trade_date):
+        position = fingerprints.index.searchsorted(pd.Timestamp(trade_date), side='right')
+        if position == 0:
+            return 0, 0
+        # 按列取值，行数（int64）和哈希（uint64）放在同一行里会被转换为浮点数
+        return int(fingerprints['行数'].iloc[position - 1]), int(fingerprints['哈希'].iloc[position - 1])
+
+    # 删除from_date（含）之后的快照，from_date为None时删除全部。这些日期的状态会被重新计算，或者交易流水已经变了
+    def discard_from(self, from_date=None):
+        for date in self.list_dates():
+            if from_date is None or date >= pd.Timestamp(from_date):
+                os.remove(self.snapshot_path(date))
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import random
+import time
+
+import pandas as pd
+
+MARKET_DATA_RECORD_DIR = 'stock/market_data_records'  # 录制的行情接口响应，供离线回放使用
+
+
+# 行情数据源接口：fetch(api, **kwargs) 返回与同名akshare接口格式相同的数据
+class MarketDataProvider:
+    def fetch(self, api, **kwargs):
+        raise NotImplementedError
+
+
+# 直接调用akshare的数据源（默认）
+class AkshareProvider(MarketDataProvider):
+    def fetch(self, api, **kwargs):
+        import akshare as ak
+        return getattr(ak, api)(**kwargs)
+
+
+# 录制数据源：把内层数据源的每一个响应保存到磁盘，供 ReplayProvider 离线回放
+class RecordingProvider(MarketDataProvider):
+    def __init__(self, inner=None, record_dir=MARKET_DATA_RECORD_DIR):
+        self.inner = inner if inner is not None else AkshareProvider()
+        self.record_dir = record_dir
+
+    def fetch(self, api, **kwargs):
+        result = self.inner.fetch(api, **kwargs)
+        path = record_path(self.record_dir, api, kwargs)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pd.to_pickle(result, path)
+        return result
+
+
+# 回放数据源：从磁盘读取录制好的响应，并模拟网络延迟（latency 秒，加上 [0, jitter] 秒的随机抖动），
+# 用于在离线机器上可重复地测试和评估抓取并发、缓存以及下游的分析计算
+class ReplayProvider(MarketDataProvider):
+    def __init__(self, record_dir=MARKET_DATA_RECORD_DIR, latency=0.0, jitter=0.0, seed=None):
+        self.record_dir = record_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def fetch(self, api, **kwargs):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        path = record_path(self.record_dir, api, kwargs)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No recorded response for {api}({kwargs}) in {self.record_dir}")
+        return pd.read_pickle(path)
+
+
+# 响应文件路径：<record_dir>/<api>/<参数的哈希>.pkl
+def record_path(record_dir, api, kwargs):
+    key = repr(sorted((name, str(value)) for name, value in kwargs.items()))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(record_dir, api, f'{digest}.pkl')
+
+
+_provider = None
+
+
+# 获取当前的数据源。没有通过 set_provider 指定时，根据环境变量创建：
+# MARKET_DATA_PROVIDER=akshare(默认)/record/replay，MARKET_DATA_RECORD_DIR 指定录制目录，
+# MARKET_DATA_LATENCY、MARKET_DATA_JITTER 指定回放时模拟的延迟（秒）
+def get_provider():
+    global _provider
+    if _provider is None:
+        mode = os.environ.get('MARKET_DATA_PROVIDER', 'akshare')
+        record_dir = os.environ.get('MARKET_DATA_RECORD_DIR', MARKET_DATA_RECORD_DIR)
+        if mode == 'replay':
+            _provider = ReplayProvider(record_dir, latency=float(os.environ.get('MARKET_DATA_LATENCY', 0)),
+                                       jitter=float(os.environ.get('MARKET_DATA_JITTER', 0)))
+        elif mode == 'record':
+            _provider = RecordingProvider(AkshareProvider(), record_dir)
+        elif mode == 'akshare':
+            _provider = AkshareProvider()
+        else:
+            raise ValueError(f"Unknown MARKET_DATA_PROVIDER: {mode}")
+    return _provider
+
+
+def set_provider(provider):
+    global _provider
+    _provider = provider
@@ -1,13 +1,15 @@
 import pandas as pd
 
+from gxTransData import AccountSummary
+from reportExporter import ReportSheet, export_report
+
 
 class FundManager:
-    def __init__(self, initial_fund_total_assets, initial_fund_units, initial_cost,analyze_summary_file, start_date):
+    def __init__(self, initial_fund_total_assets, initial_fund_units, initial_cost, start_date):
         self.fund_total_assets = initial_fund_total_assets  # 基金总资产
         self.fund_units = initial_fund_units  # 基金总份额
         self.fund_reserve = 0.0  # 用于处理临时调拨
         self.fund_data_history = []  # 保存每日基金的历史记录
-        self.analyze_summary_file = analyze_summary_file  # 分析报告文件路径
         self.start_date = pd.to_datetime(start_date)  # 开始计算的日期
         self.daily_assets = {}  # 存储每日基金净资产
 
@@ -75,20 +77,13 @@ class FundManager:
         """
         预计算每日基金总资产并存储
         """
-        analyze_summary = pd.read_excel(self.analyze_summary_file)
-
-        for date in analyze_summary['交收日期'].unique():
-            date = pd.to_datetime(date)
-
-            if date < self.start_date:
-                continue
-
-            daily_summary = analyze_summary[analyze_summary['交收日期'] == date]
-
-            guoxin_accounts = daily_summary[daily_summary['账户类型'].isin(['国信账户', '国信融资账户'])]
-            total_assets = guoxin_accounts['资产净值'].sum()
+        # 只从账户历史数据库读取开始日期之后的账户余额
+        analyze_summary = AccountSummary.load_balance_from_file(self.start_date)
 
-            self.daily_assets[date] = total_assets
+        guoxin_accounts = analyze_summary[analyze_summary['账户类型'].isin(['国信账户', '国信融资账户'])]
+        daily_assets = guoxin_accounts.groupby('交收日期')['资产净值'].sum()
+        # 只有B股记录的日子总资产为0
+        self.daily_assets = daily_assets.reindex(analyze_summary['交收日期'].unique(), fill_value=0.0).to_dict()
 
 
     def calculate_user_balances(self, date):
@@ -210,49 +205,32 @@ class FundManager:
         fund_assets_report['基金总资产'] = fund_assets_report['基金总资产'].astype(float)
         fund_assets_report['基金总利润'] = fund_assets_report['基金总利润'].astype(float)
         fund_assets_report['基金净值'] = fund_assets_report['基金净值'].astype(float)
-        # 使用 ExcelWriter 输出多个 sheet
-        with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
-            # 设置数值格式
-            workbook = writer.book
-            number_format = workbook.add_format({'num_format': '#,##0'})  # 整数格式
-            float_format = workbook.add_format({'num_format': '#,##0.00'})  # 小数格式
-            percent_format = workbook.add_format({'num_format': '0.00%'})  # 百分比格式
-
-            # 输出用户余额表
-            all_balances.to_excel(writer, sheet_name='基金用户明细', index=False)
-
-            worksheet_balances = writer.sheets['基金用户明细']
-            # 设置列宽
-            for idx, column in enumerate(all_balances.columns):
-                max_len = max(all_balances[column].astype(str).map(len).max(), len(column)) + 8
-                worksheet_balances.set_column(idx, idx, max_len)
-            worksheet_balances.set_column('C:C', None, number_format)  # 设置持有份额为整数格式
-            worksheet_balances.set_column('D:D', None, number_format)  # 设置用户成本为整数格式
-            worksheet_balances.set_column('E:E', None, percent_format)  # 设置份额占比为百分比格式
-            worksheet_balances.set_column('F:F', None, number_format)  # 设置用户利润为整数格式
-            worksheet_balances.set_column('G:G', None, number_format)  # 设置资产价值为整数格式
-            worksheet_balances.set_column('H:H', None, float_format)
-
-            # 设置基金净值为数值格式
-
-            # 输出基金资产表
-            fund_assets_report.to_excel(writer, sheet_name='基金资产净值', index=False)
-            worksheet_assets = writer.sheets['基金资产净值']
-            # 设置列宽
-            for idx, column in enumerate(fund_assets_report.columns):
-                max_len = max(fund_assets_report[column].astype(str).map(len).max(), len(column)) + 8
-                worksheet_assets.set_column(idx, idx, max_len)
-
-            worksheet_assets.set_column('B:B', None, number_format)  # 设置基金总份额为整数格式
-            worksheet_assets.set_column('C:C', None, number_format)  # 设置基金总资产为数值格式
-            worksheet_assets.set_column('D:D', None, number_format)
-            worksheet_assets.set_column('E:E', None, number_format)
-            worksheet_assets.set_column('F:F', None, float_format)  # 设置基金净值为数值格式
+        # 设置数值格式
+        number_format = {'num_format': '#,##0'}  # 整数格式
+        float_format = {'num_format': '#,##0.00'}  # 小数格式
+        percent_format = {'num_format': '0.00%'}  # 百分比格式
+        # 输出用户余额表和基金资产表两个 sheet，列宽按数据估算后再加8
+        export_report(output_file, [
+            ReportSheet('基金用户明细', all_balances, formats={
+                '持有份额': number_format,  # 设置持有份额为整数格式
+                '用户成本': number_format,  # 设置用户成本为整数格式
+                '份额占比': percent_format,  # 设置份额占比为百分比格式
+                '资产价值': number_format,  # 设置资产价值为整数格式
+                '用户利润': number_format,  # 设置用户利润为整数格式
+                '基金净值': float_format,
+            }, width_padding=8, max_width=None),
+            ReportSheet('基金资产净值', fund_assets_report, formats={
+                '基金总份额': number_format,  # 设置基金总份额为整数格式
+                '基金总成本': number_format,
+                '基金总资产': number_format,  # 设置基金总资产为数值格式
+                '基金总利润': number_format,
+                '基金净值': float_format,  # 设置基金净值为数值格式
+            }, width_padding=8, max_width=None),
+        ])
         print(f"每日资产余额及基金占比已输出至 {output_file}")
 
 
 # 示例用法
-summary_file = 'analyze_summary.xlsx'
 # base_date = '2015-07-01'
 # base_assets = 2203414.09
 base_date = '2014-12-01'
@@ -262,7 +240,7 @@ base_units = round(base_assets, 0)
 
 
 fund = FundManager(initial_fund_total_assets=base_assets, initial_fund_units=base_units, initial_cost=base_cost,
-                   analyze_summary_file=summary_file, start_date=base_date)
+                   start_date=base_date)
 
 csv_file_path = 'stock/fund_cashflow.csv'
 
@@ -0,0 +1,97 @@
+import pandas as pd
+
+
+# 一条持仓记录。当日市值/浮动盈亏/备注只是从持仓文件中带过来的占位数据，回放交易时不会更新
+# seq 是持仓建立的先后顺序，按账户分开回放后合并时用它恢复与单个持仓表相同的行顺序
+class Position:
+    __slots__ = ('seq', 'account_type', 'stock_code', 'stock_name', 'quantity', 'cost', 'market_value',
+                 'float_profit', 'remark')
+
+    def __init__(self, seq, account_type, stock_code, stock_name, quantity, cost, market_value=None,
+                 float_profit=None, remark=None):
+        self.seq = seq
+        self.account_type = account_type
+        self.stock_code = stock_code
+        self.stock_name = stock_name
+        self.quantity = quantity
+        self.cost = cost
+        self.market_value = market_value
+        self.float_profit = float_profit
+        self.remark = remark
+
+    # (seq, 账户类型, 证券代码, 证券名称, 持股数量, 持股成本, 当日市值, 浮动盈亏, 备注)
+    def to_record(self):
+        return (self.seq, self.account_type, self.stock_code, self.stock_name, self.quantity, self.cost,
+                self.market_value, self.float_profit, self.remark)
+
+
+# 以 (账户类型, 证券代码) 为键的内存持仓表，回放交易流水时代替每日的持仓DataFrame，
+# 查找和更新持仓都是一次字典操作，只在需要输出时才生成DataFrame
+class PositionLedger:
+    COLUMNS = ['交收日期', '账户类型', '证券代码', '证券名称', '持股数量', '持股成本', '当日市值', '浮动盈亏', '备注']
+
+    def __init__(self, trade_date=None):
+        self.positions = {}  # (账户类型, 证券代码) -> Position，保持插入顺序
+        self.trade_date = trade_date  # 持仓所对应的交收日期
+        self.next_seq = 0  # update 没有指定 seq 时新建持仓使用的顺序号
+
+    # 从持仓DataFrame（init_stockhold_record 的格式）创建持仓表，
+    # 持仓的 seq 按行的顺序编为 -n ~ -1，排在回放中新建的持仓之前
+    @classmethod
+    def from_frame(cls, holdings_df):
+        ledger = cls()
+        if len(holdings_df) == 0:
+            return ledger
+        ledger.trade_date = holdings_df['交收日期'].iloc[-1]
+        for seq, row in zip(range(-len(holdings_df), 0), holdings_df.to_dict('records')):
+            ledger.positions[(row['账户类型'], row['证券代码'])] = Position(
+                seq, row['账户类型'], row['证券代码'], row['证券名称'], row['持股数量'], row['持股成本'],
+                row.get('当日市值'), row.get('浮动盈亏'), row.get('备注'))
+        return ledger
+
+    # 从 Position.to_record 的记录创建持仓表
+    @classmethod
+    def from_records(cls, records, trade_date=None):
+        ledger = cls(trade_date)
+        for record in records:
+            ledger.positions[(record[1], record[2])] = Position(*record)
+        return ledger
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, account_type, stock_code):
+        return self.positions.get((account_type, stock_code))
+
+    # 用一笔交易更新持仓：持股数量加上trade_quantity，持股成本减去trade_amount；没有持仓时新建
+    def update(self, account_type, stock_code, stock_name, trade_amount, trade_quantity, seq=None):
+        position = self.positions.get((account_type, stock_code))
+        if position is None:
+            if seq is None:
+                seq = self.next_seq
+                self.next_seq += 1
+            self.positions[(account_type, stock_code)] = Position(seq, account_type, stock_code, stock_name,
+                                                                  trade_quantity, trade_amount * -1)
+        else:
+            position.quantity += trade_quantity
+            position.cost -= trade_amount
+
+    # 取出并删除持股数量为0（已清仓）的持仓
+    def pop_closed(self):
+        closed = [position for position in self.positions.values() if position.quantity == 0]
+        for position in closed:
+            del self.positions[(position.account_type, position.stock_code)]
+        return closed
+
+    def to_records(self):
+        return [position.to_record() for position in self.positions.values()]
+
+    def to_frame(self, positions=None):
+        positions = self.positions.values() if positions is None else positions
+        return self.records_to_frame([position.to_record() for position in positions], self.trade_date)
+
+    # 由 Position.to_record 的记录生成持仓DataFrame（不包含seq）
+    @staticmethod
+    def records_to_frame(records, trade_date):
+        return pd.DataFrame.from_records([(trade_date,) + record[1:] for record in records],
+                                         columns=PositionLedger.COLUMNS)
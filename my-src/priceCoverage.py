@@ -0,0 +1,94 @@
+import os
+import pickle
+
+import pandas as pd
+
+PRICE_COVERAGE_FILE = 'stock/price_coverage.pkl'  # 每个证券代码已经抓取过的收盘价日期区间
+# 覆盖清单文件的格式版本。版本1按年份分区初始化，跨年的节假日会被当成缺失的区间，需要重新初始化
+COVERAGE_VERSION = 2
+
+
+# 收盘价的覆盖清单：记录每个证券代码已经抓取并保存过的日期区间（左闭右闭）。
+# 区间内没有行情的日期（节假日、停牌等）同样算作已覆盖，不会被重新请求。
+# 抓取时只请求 需要的区间 - 已覆盖区间 的差集，避免重复下载已有的数据
+class PriceCoverage:
+    def __init__(self, file=PRICE_COVERAGE_FILE):
+        self.file = file
+        self.intervals = {}  # 证券代码 -> 已合并、按开始日期排序的 [(start, end), ...]
+
+    @classmethod
+    def load(cls, file=PRICE_COVERAGE_FILE):
+        coverage = cls(file)
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                state = pickle.load(f)
+            # 旧版本的清单丢弃，由调用方根据价格存储重新初始化
+            if state.get('version') == COVERAGE_VERSION:
+                coverage.intervals = state['intervals']
+        return coverage
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        with open(self.file, 'wb') as f:
+            pickle.dump({'version': COVERAGE_VERSION, 'intervals': self.intervals}, f)
+
+    def is_empty(self):
+        return len(self.intervals) == 0
+
+    # 用价格存储里已有的数据初始化覆盖清单：每个证券代码在所有年份分区中的 [最早日期, 最晚日期] 视为已覆盖。
+    # 按证券代码跨年份取区间，元旦等跨年的节假日不会被当成缺失的区间
+    def bootstrap_from_store(self, price_store):
+        print("根据已有的价格存储初始化收盘价覆盖清单")
+        years = {}  # 证券代码 -> 有分区的年份列表（升序）
+        for year, stock_code in price_store.list_partitions():
+            years.setdefault(stock_code, []).append(year)
+        for stock_code, code_years in years.items():
+            # 最早日期只在最早的年份分区里，最晚日期只在最晚的年份分区里
+            first_dates = self.read_dates(price_store, min(code_years), stock_code)
+            last_dates = self.read_dates(price_store, max(code_years), stock_code)
+            if len(first_dates) > 0 and len(last_dates) > 0:
+                self.add(stock_code, first_dates.min(), last_dates.max())
+
+    @staticmethod
+    def read_dates(price_store, year, stock_code):
+        return pd.read_parquet(price_store.partition_path(year, stock_code), columns=['日期'])['日期']
+
+    # 记录某证券代码的一个已抓取区间
+    def add(self, stock_code, start_date, end_date):
+        start_date = pd.to_datetime(start_date).normalize()
+        end_date = pd.to_datetime(end_date).normalize()
+        if end_date < start_date:
+            return
+        self.intervals[stock_code] = self.merge_intervals(self.intervals.get(stock_code, []) +
+                                                          [(start_date, end_date)])
+
+    # 返回 [start_date, end_date] 中还没有被覆盖的子区间列表
+    def missing(self, stock_code, start_date, end_date):
+        start_date = pd.to_datetime(start_date).normalize()
+        end_date = pd.to_datetime(end_date).normalize()
+        missing_ranges = []
+        current = start_date
+        for held_start, held_end in self.intervals.get(stock_code, []):
+            if held_end < current:
+                continue
+            if held_start > end_date:
+                break
+            if held_start > current:
+                missing_ranges.append((current, held_start - pd.Timedelta(days=1)))
+            current = held_end + pd.Timedelta(days=1)
+            if current > end_date:
+                break
+        if current <= end_date:
+            missing_ranges.append((current, end_date))
+        return missing_ranges
+
+    # 合并重叠或首尾相邻（相差一天）的区间
+    @staticmethod
+    def merge_intervals(intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + pd.Timedelta(days=1):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
@@ -0,0 +1,102 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+WIDTH_SAMPLE_ROWS = 1000  # 估算列宽时最多抽取的行数
+DATE_FORMAT = 'yyyy/mm/dd'  # 日期列的显示格式
+DEFAULT_MAX_WIDTH = 40
+
+
+# 报表中的一个sheet：数据和每列的显示格式、列宽
+class ReportSheet:
+    def __init__(self, name, frame, formats=None, widths=None, width_padding=0, max_width=DEFAULT_MAX_WIDTH):
+        """
+        :param name: sheet名，导出为Parquet/CSV时用作文件名的一部分
+        :param frame: 数据
+        :param formats: {列名: xlsxwriter格式字典}，例如 {'用户成本': {'num_format': '#,##0'}}
+        :param widths: {列名: 固定列宽}，没有指定的列按抽样的行估算列宽
+        :param width_padding: 估算的列宽再加上的宽度
+        :param max_width: 估算列宽的上限，None为不限制
+        """
+        self.name = name
+        self.frame = frame
+        self.formats = formats or {}
+        self.widths = widths or {}
+        self.width_padding = width_padding
+        self.max_width = max_width
+
+    # 估算每列的宽度：最长的单元格文本和列名的长度。行数多时只均匀抽取 WIDTH_SAMPLE_ROWS 行来估算
+    def column_widths(self, sample_rows=WIDTH_SAMPLE_ROWS):
+        frame = self.frame
+        if len(frame) > sample_rows:
+            frame = frame.iloc[np.linspace(0, len(frame) - 1, sample_rows).astype(int)]
+        widths = []
+        for col in frame.columns:
+            if col in self.widths:
+                widths.append(self.widths[col])
+                continue
+            if pd.api.types.is_datetime64_any_dtype(frame[col]):
+                cell_width = len(DATE_FORMAT)
+            else:
+                cell_width = frame[col].astype(str).str.len().fillna(0).max() if len(frame) > 0 else 0
+            width = max(cell_width, len(str(col))) + self.width_padding
+            if self.max_width is not None:
+                width = min(width, self.max_width)
+            widths.append(width)
+        return widths
+
+
+# 转换为xlsxwriter能直接写入的值：空值为None，字典等其它对象写成文本
+def to_cell_values(frame):
+    object_columns = [col for col in frame.columns if frame[col].dtype == object]
+    frame = frame.astype(object).where(frame.notna(), None)
+    for col in object_columns:
+        if not frame[col].map(lambda value: value is None or isinstance(
+                value, (str, bool, int, float, datetime.date))).all():
+            frame[col] = frame[col].map(lambda value: value if value is None else str(value))
+    return frame
+
+
+# 用xlsxwriter的constant_memory模式逐行写出所有sheet，数据、格式和列宽在同一遍中写完，不需要再打开文件设置格式
+def write_excel(output_file, sheets):
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'nan_inf_to_errors': True,
+                                                 'default_date_format': DATE_FORMAT})
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for sheet in sheets:
+        worksheet = workbook.add_worksheet(sheet.name)
+        # constant_memory模式下只能按行的顺序写，列宽和列格式要在写数据之前设置
+        for idx, (col, width) in enumerate(zip(sheet.frame.columns, sheet.column_widths())):
+            cell_format = workbook.add_format(sheet.formats[col]) if col in sheet.formats else None
+            worksheet.set_column(idx, idx, width, cell_format)
+        worksheet.write_row(0, 0, [str(col) for col in sheet.frame.columns], header_format)
+        for row, values in enumerate(to_cell_values(sheet.frame).itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row, 0, values)
+    workbook.close()
+
+
+# 给机器读取的Parquet/CSV输出，每个sheet一个文件。只有一个sheet时就是output_file，
+# 否则为 <output_file去掉后缀>-<sheet名><后缀>
+def write_files(output_file, sheets):
+    stem, suffix = os.path.splitext(output_file)
+    for sheet in sheets:
+        path = output_file if len(sheets) == 1 else f'{stem}-{sheet.name}{suffix}'
+        if suffix.lower() == '.parquet':
+            sheet.frame.to_parquet(path, index=False)
+        else:
+            sheet.frame.to_csv(path, index=False, encoding='utf-8-sig')
+
+
+# 按 output_file 的后缀导出报表：.xlsx 为一个多sheet的Excel文件，.parquet / .csv 为每个sheet一个文件
+def export_report(output_file, sheets):
+    if isinstance(sheets, ReportSheet):
+        sheets = [sheets]
+    suffix = os.path.splitext(output_file)[1].lower()
+    if suffix == '.xlsx':
+        write_excel(output_file, sheets)
+    elif suffix in ('.parquet', '.csv'):
+        write_files(output_file, sheets)
+    else:
+        raise ValueError(f"不支持的报表格式：{output_file}，只支持 .xlsx、.parquet、.csv")
@@ -0,0 +1,80 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from fund_data_handler import FundDataHandler
+
+
+# 证券代码的市场分类器，StockPriceHistory 和 MarketDataHelper 共用
+# 对整列证券代码一次性做向量化分类：基金/指数代码用集合查找，前缀规则编译为正则匹配，
+# 返回一个分类（categorical）的市场列，可以直接用于 groupby 分派
+class SecurityClassifier:
+    UNKNOWN = '未知类型'
+    MARKETS = ['ETF基金', '分级基金', '香港指数', '港股股票', '上海A股', '深圳A股', 'B股股票', 'A股基金', 'A股新股',
+               UNKNOWN]
+
+    # 按代码集合查找的分类，优先于长度和前缀规则
+    CODE_SETS = [
+        ('ETF基金', frozenset(FundDataHandler.ETF_FUNDS)),
+        ('分级基金', frozenset(FundDataHandler.GRADE_FUNDS)),
+        ('香港指数', frozenset(FundDataHandler.HK_INDEXES)),
+    ]
+    # 6位代码的前缀规则，按顺序匹配，先匹配的优先
+    PREFIX_RULES = [
+        ('上海A股', r'6'),
+        ('深圳A股', r'00|30'),
+        ('B股股票', r'900'),
+        ('A股基金', r'5'),
+        ('A股新股', r'7'),
+    ]
+    PREFIX_PATTERNS = [(market, re.compile(pattern)) for market, pattern in PREFIX_RULES]  # judge 逐个代码匹配时使用
+
+    @staticmethod
+    def classify(codes):
+        """
+        对一列证券代码做市场分类
+
+        :param codes: 证券代码序列（Series 时保留原来的 index）
+        :return: 名为'市场'的分类Series，类别为 SecurityClassifier.MARKETS
+        """
+        codes = codes if isinstance(codes, pd.Series) else pd.Series(list(codes), dtype=object)
+        is_str = codes.map(lambda code: isinstance(code, str)).to_numpy(dtype=bool)
+        codes_str = codes.where(is_str, '').astype(str)
+
+        markets = np.full(len(codes), SecurityClassifier.UNKNOWN, dtype=object)
+        assigned = ~is_str
+
+        def assign(mask, market):
+            nonlocal assigned
+            mask = np.asarray(mask, dtype=bool) & ~assigned
+            markets[mask] = market
+            assigned = assigned | mask
+
+        for market, code_set in SecurityClassifier.CODE_SETS:
+            assign(codes_str.isin(code_set), market)
+        lengths = codes_str.str.len()
+        assign(lengths < 5, SecurityClassifier.UNKNOWN)
+        assign(lengths == 5, '港股股票')
+        for market, pattern in SecurityClassifier.PREFIX_RULES:
+            assign(codes_str.str.match(pattern), market)
+
+        return pd.Series(pd.Categorical(markets, categories=SecurityClassifier.MARKETS), index=codes.index,
+                         name='市场')
+
+    # 单个证券代码的市场分类：与 classify 的规则相同，直接对字符串判断，不构造Series
+    @staticmethod
+    def judge(code):
+        if not isinstance(code, str):
+            return SecurityClassifier.UNKNOWN
+        for market, code_set in SecurityClassifier.CODE_SETS:
+            if code in code_set:
+                return market
+        if len(code) < 5:
+            return SecurityClassifier.UNKNOWN
+        if len(code) == 5:
+            return '港股股票'
+        for market, pattern in SecurityClassifier.PREFIX_PATTERNS:
+            if pattern.match(code):
+                return market
+        return SecurityClassifier.UNKNOWN
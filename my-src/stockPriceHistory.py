@@ -1,66 +1,167 @@
 import datetime
 import os
+import time
 from datetime import timedelta
 
-import akshare as ak
+import numpy as np
 import pandas as pd
 
 import gxTransParser
+from fetchExecutor import FetchExecutor, FetchTask
 from fund_data_handler import FundDataHandler
 from gxTransData import AccountSummary
+from marketDataProvider import get_provider
+from priceCoverage import PriceCoverage
+from securityClassifier import SecurityClassifier
+from stockPriceStore import StockPriceStore
+from tradeCalendar import TradeCalendar, TRADE_DATES_FILE
 
-ALL_STOCK_HIST_DF_PKL = 'stock/all_stock_hist_df.pkl'  # 所有股票价格
+ALL_STOCK_HIST_DF_PKL = 'stock/all_stock_hist_df.pkl'  # 所有股票价格（旧的单文件格式，仅用于迁移到分区存储）
 HGT_EXCHANGE_RATE_FILE = 'stock/hgt_exchange_rate.pkl'  # 沪港通结算汇率
-TRADE_DATES = 'stock/trade_dates.pkl'  # 交易日
+HGT_EXCHANGE_RATE_MAX_AGE = timedelta(hours=12)  # 本地结算汇率表超过这个时间才重新从akshare刷新
+TRADE_DATES = TRADE_DATES_FILE  # 交易日
 ALL_HFQ_FACTORS_PKL = 'stock/all_hfq_factors.pkl'
+ALL_HFQ_FACTORS_META_PKL = 'stock/all_hfq_factors_meta.pkl'  # 每个证券代码后复权因子的最后刷新时间
+HFQ_FACTORS_MAX_AGE = timedelta(days=7)  # 价格存储中没有某代码的收盘价、无法按收盘价日期判断时，后复权因子超过这个时间没有刷新则视为过期
 
 AK_ADJUST_HFQ = "hfq-factor"  # 后复权模式
 AK_ADJUST_NONE = ""  # 不复权
 
+# 各市场对应的行情接口，同一个接口共用一个限速器
+AK_ENDPOINTS = {
+    '上海A股': 'stock_zh_a_hist',
+    '深圳A股': 'stock_zh_a_hist',
+    '分级基金': 'grade_fund_hist',
+    'ETF基金': 'fund_etf_fund_info_em',
+    'B股股票': 'stock_zh_b_daily',
+    '港股股票': 'stock_hk_hist',
+    '香港指数': 'stock_hk_index_daily_sina',
+}
+# 各市场对应的后复权因子接口（新浪）
+AK_HFQ_ENDPOINTS = {
+    '上海A股': 'stock_zh_a_daily',
+    '深圳A股': 'stock_zh_a_daily',
+    'B股股票': 'stock_zh_b_daily',
+    '港股股票': 'stock_hk_daily',
+}
+# 各接口相邻两次请求的最小间隔（秒），本地缓存的分级基金不限速
+AK_RATE_LIMITS = {
+    'stock_zh_a_hist': 0.2,
+    'grade_fund_hist': 0.0,
+    'fund_etf_fund_info_em': 0.5,
+    'stock_zh_b_daily': 1.0,
+    'stock_hk_hist': 0.5,
+    'stock_hk_index_daily_sina': 1.0,
+    'stock_zh_a_daily': 1.0,
+    'stock_hk_daily': 1.0,
+}
+
 
 class StockPriceHistory:
 
     def __init__(self):
         self.stock_price_df = None  # Initialize data attribute
-
-    # 从本地存储中，获取股票价格的dataframe
-    def get_stock_price_df(self, start_date=None):
-        if self.stock_price_df is None:  # 如果数据为空，则从文件中加载
-            if os.path.exists(ALL_STOCK_HIST_DF_PKL):  # 如果有历史文件，从历史文件里加载
-                self.stock_price_df = self.load_from_local(ALL_STOCK_HIST_DF_PKL)
-                if start_date:  # 获取start_date之后的数据
-                    self.stock_price_df = self.stock_price_df[self.stock_price_df['日期'] >= start_date]
+        self.stock_price_key = None  # 加载 stock_price_df 时的 (start_date, end_date, codes)
+        self.price_index = None  # 证券代码 -> (有序的日期数组, 收盘价数组)，用于批量查询收盘价
+        self.price_store = StockPriceStore()
+        self.price_coverage = None
+
+    # 获取本地的分区价格存储，如果只有旧的单文件pickle，先一次性迁移过来
+    def get_price_store(self):
+        if self.price_store.is_empty() and os.path.exists(ALL_STOCK_HIST_DF_PKL):
+            self.price_store.migrate_from_pickle(ALL_STOCK_HIST_DF_PKL)
+        return self.price_store
+
+    # 获取收盘价覆盖清单，如果还没有清单但已有价格存储，用存储中的数据初始化
+    def get_price_coverage(self):
+        if self.price_coverage is None:
+            self.price_coverage = PriceCoverage.load()
+            if self.price_coverage.is_empty() and not self.get_price_store().is_empty():
+                self.price_coverage.bootstrap_from_store(self.price_store)
+                self.price_coverage.save()
+        return self.price_coverage
+
+    # 从本地存储中，获取股票价格的dataframe（只读取start_date之后、指定证券代码的分区）。
+    # 参数与上次加载时相同才使用已加载的数据，否则重新加载（同时作废按上次数据建立的收盘价索引）
+    def get_stock_price_df(self, start_date=None, end_date=None, codes=None):
+        key = (None if start_date is None else pd.Timestamp(start_date),
+               None if end_date is None else pd.Timestamp(end_date),
+               None if codes is None else tuple(sorted({str(code) for code in codes})))
+        if self.stock_price_df is None or key != self.stock_price_key:
+            self.stock_price_df = self.get_price_store().read(start_date, end_date, codes)
+            self.stock_price_key = key
+            self.price_index = None
         return self.stock_price_df
 
-    # 获取某个股票某日的收盘价，一般直接做inner join，而不是用这个函数
+    # 获取某个股票某日的收盘价，一般直接做inner join或者用get_close_prices批量查询，而不是用这个函数
     def get_close_price(self, stock_code, trade_date):
-        if self.stock_price_df is None:
-            raise ValueError("Data has not been initialized. Call get_stock_price_df first.")
-        result = self.stock_price_df[
-            (self.stock_price_df['证券代码'] == stock_code) & (self.stock_price_df['日期'] == trade_date)]
-        if len(result) == 1:
-            return result['收盘'].values[0]
-        else:
+        close_price = self.get_close_prices([stock_code], [trade_date], asof=False)[0]
+        if np.isnan(close_price):
             return None
+        return close_price
 
-    # 从akshare获取收盘价，增量更新模式，在原有数据文件基础上继续加载数据（最后会去重）
+    # 按证券代码建立有序的日期数组和收盘价数组
+    def build_price_index(self):
+        if self.stock_price_df is None:
+            raise ValueError("Data has not been initialized. Call get_stock_price_df first.")
+        price_df = self.stock_price_df.sort_values(['证券代码', '日期'], kind='stable')
+        codes = price_df['证券代码'].to_numpy(dtype=object)
+        dates = price_df['日期'].to_numpy(dtype='datetime64[ns]')
+        closes = price_df['收盘'].to_numpy(dtype=float)
+        # 每个证券代码在排序后数组中的起止位置
+        boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        starts = np.r_[0, boundaries]
+        ends = np.r_[boundaries, len(codes)]
+        self.price_index = {codes[start]: (dates[start:end], closes[start:end])
+                            for start, end in zip(starts, ends) if end > start}
+        return self.price_index
+
+    def get_close_prices(self, codes, dates, asof=True):
+        """
+        批量查询收盘价，每个证券代码只做一次searchsorted
+
+        :param codes: 证券代码序列
+        :param dates: 与codes等长的日期序列
+        :param asof: True时返回该日或之前最近一个交易日的收盘价（停牌股票取停牌前的收盘价），False时只返回当日收盘价
+        :return: 与输入等长的收盘价数组，查不到的为NaN
+        """
+        if self.price_index is None:
+            self.build_price_index()
+        codes = pd.Series(np.asarray(codes, dtype=object))
+        dates = pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]')
+        if len(codes) != len(dates):
+            raise ValueError("codes and dates must have the same length")
+
+        close_prices = np.full(len(codes), np.nan)
+        for stock_code, positions in codes.groupby(codes).indices.items():
+            if stock_code not in self.price_index:
+                continue
+            code_dates, code_closes = self.price_index[stock_code]
+            query_dates = dates[positions]
+            # 找到每个查询日期当日或之前最近的一个交易日
+            price_idx = np.searchsorted(code_dates, query_dates, side='right') - 1
+            found = price_idx >= 0
+            if not asof:
+                found &= code_dates[np.maximum(price_idx, 0)] == query_dates
+            close_prices[positions[found]] = code_closes[price_idx[found]]
+        return close_prices
+
+    # 从akshare获取收盘价，增量更新模式，在原有数据基础上只抓取覆盖清单中缺少的日期区间
     # 这里需要两类数据： 1. 获取持仓股票的收盘价。 2. 获取爬取交易流水数据的收盘价
     def fetch_close_price_from_ak(self, start_date=None):
         # 1. 获取持仓股票的收盘价
-        stock_hold_df = AccountSummary.load_stockhold_from_file()
-
         if start_date is None:  # 开始日期为空，则从20070501开始
             start_date = pd.to_datetime("20070501")
+            stock_hold_df = AccountSummary.load_stockhold_from_file()
         else:
-            # 找到离 start_date 最近的交收日期对应的行索引
-            prev_date_idx = stock_hold_df['交收日期'].sub(start_date).abs().idxmin()
-            # 找到离 start_date 最近的交收日期(可以是当天）
-            prev_date = stock_hold_df.loc[prev_date_idx]['交收日期']
-            print(f'找到开始更新日期的最近持仓日期{prev_date}')
-            stock_hold_df = stock_hold_df[stock_hold_df['交收日期'] >= prev_date]
-            # 根据最接近的持仓股票的交收日期修改start_date（因为在下面的代码里这个日期如果小于start_date会被过滤掉）
-            if prev_date < start_date:
+            # 找到 start_date 当天或之前最近的交收日期，只从账户历史数据库读取这一天之后的持仓
+            prev_date = AccountSummary.history_db().latest_date('账户余额历史',
+                                                                before_date=start_date + pd.Timedelta(days=1))
+            if prev_date is not None:
+                print(f'找到开始更新日期的最近持仓日期{prev_date}')
+                # 根据最接近的持仓股票的交收日期修改start_date（因为在下面的代码里这个日期如果小于start_date会被过滤掉）
                 start_date = prev_date
+            stock_hold_df = AccountSummary.load_stockhold_from_file(start_date)
 
         stock_hold_df = stock_hold_df[["交收日期", "证券代码"]]
 
@@ -73,63 +174,61 @@ class StockPriceHistory:
         # 结束日期设为今天之后一天
         end_date = (datetime.datetime.now() + datetime.timedelta(days=1))
 
-        all_stock_hist_df, failed_codes = self.query_ak_for_stocks(stock_df, start_date,
-                                                                   end_date)
+        stock_price_df, failed_codes = self.query_ak_for_stocks(stock_df, start_date, end_date)
 
-        return all_stock_hist_df, failed_codes
+        return stock_price_df, failed_codes
 
     @staticmethod
     # 将一段时间的不复权价格转换为以特定日期为基准的后复权价格
     # 为了模拟评估模式：从akshare为持仓数据获取从某日开始后复权的收盘价，不保存本地
     def cal_hfq_price(stock_price_df, hfq_data, base_date=None):
-        # 这段代码的主要步骤如下:
-        # 不复权价格: stock_price_df
-        # 后复权因子数据: hfq_data。
-        # 设置后复权基准日期为base_date。
-        # 创建一个新的列hfq_factor来存储每个交易日的后复权因子。初始值为1.0
-        # 遍历hfq_data中的每个后复权因子, 并根据对应的时间范围, 将stock_data中的hfq_factor列更新为该因子除以基准日期的因子。这样可以确保后复权价格是以基准日期为基准的。
-        # 最后, 我们计算adj_close列, 即后复权价格, 方法是将close列乘以hfq_factor列。
+        # 单只股票的后复权因子数据可能没有证券代码列，补上后交给批量后复权计算
+        if '证券代码' not in hfq_data.columns:
+            hfq_data = hfq_data.assign(证券代码=stock_price_df['证券代码'].iloc[0])
+        return StockPriceHistory.cal_hfq_prices(stock_price_df, hfq_data, base_date)
 
-        # 对hfq_data按日期排序
-        hfq_data = hfq_data.sort_values('日期')
+    @staticmethod
+    # 批量后复权：对整个价格面板（所有股票）和整个后复权因子表，一次按证券代码做merge_asof完成计算
+    def cal_hfq_prices(stock_price_df, hfq_factors, base_date=None):
+        # 这段代码的主要步骤如下:
+        # 不复权价格: stock_price_df，可以包含多只股票
+        # 后复权因子数据: hfq_factors，即 all_hfq_factors.pkl 的格式：证券代码 日期 hfq_factor
+        # 对每只股票，以base_date当天或之前最近的因子作为基准因子（base_date早于所有因子时取最早的因子）。
+        # 每个交易日适用的因子为该日当天或之前最近的因子（merge_asof backward），后复权因子 = 适用因子 / 基准因子，
+        # 基准因子日期之前的交易日，以及没有因子数据的股票，后复权因子保持为1.0。
+        # 最后, 后复权收盘 = 收盘 * 后复权因子。
 
         # 设置基准日期base_date
         if base_date is None:
             base_date = stock_price_df['日期'].min()
         base_date = pd.to_datetime(base_date)
 
-        # 找到base_date在hfq_data中最近的日期
-        base_date_idx = hfq_data['日期'].searchsorted(base_date, side='right')
-        if base_date_idx > 0:
-            base_date = hfq_data['日期'].iloc[base_date_idx - 1]
-
-        # 过滤掉hfq_data中小于base_date的数据
-        hfq_data = hfq_data.loc[hfq_data['日期'] >= base_date]
-
-        # 将hfq_data['hfq_factor']转换为数值类型
-        hfq_data['hfq_factor'] = hfq_data['hfq_factor'].astype(float)
-
-        # 在原始DataFrame中插入'后复权因子'和'后复权收盘'两列
-        stock_price_df.insert(len(stock_price_df.columns), '后复权因子', 1.0)
-        stock_price_df.insert(len(stock_price_df.columns), '后复权收盘', stock_price_df['收盘'])
-
-        # 计算每个交易日的后复权因子
-        for i in range(len(hfq_data)):
-            start_date = hfq_data['日期'].iloc[i]
-            if i == len(hfq_data) - 1:
-                # 对于最后一次除权数据之后的日期，不设end_date的限制
-                stock_price_df.loc[stock_price_df['日期'] >= start_date, '后复权因子'] = \
-                    hfq_data['hfq_factor'].iloc[i] / hfq_data['hfq_factor'].loc[hfq_data['日期'] == base_date].values[
-                        0]
-            else:
-                end_date = hfq_data['日期'].iloc[i + 1]
-                stock_price_df.loc[
-                    (stock_price_df['日期'] >= start_date) & (stock_price_df['日期'] < end_date), '后复权因子'] = \
-                    hfq_data['hfq_factor'].iloc[i] / hfq_data['hfq_factor'].loc[hfq_data['日期'] == base_date].values[
-                        0]
-
+        factors = hfq_factors[['证券代码', '日期', 'hfq_factor']].copy()
+        factors['日期'] = pd.to_datetime(factors['日期']).astype('datetime64[ns]')
+        factors['hfq_factor'] = factors['hfq_factor'].astype(float)
+        factors = factors.dropna(subset=['日期']).sort_values('日期', kind='stable')
+
+        # 每只股票的基准因子和基准因子日期
+        base_factors = factors.groupby('证券代码')[['日期', 'hfq_factor']].first()
+        base_factors.update(factors[factors['日期'] <= base_date].groupby('证券代码')[['日期', 'hfq_factor']].last())
+        base_factors.columns = ['基准因子日期', '基准因子']
+
+        # 保留原始的行顺序，merge_asof需要按日期排序
+        prices = stock_price_df.copy()
+        prices['日期'] = pd.to_datetime(prices['日期']).astype('datetime64[ns]')
+        prices['_row'] = np.arange(len(prices))
+        merged = pd.merge_asof(prices.sort_values('日期', kind='stable'), factors, on='日期', by='证券代码',
+                               direction='backward')
+        merged = merged.join(base_factors, on='证券代码')
+
+        in_range = merged['hfq_factor'].notna() & (merged['日期'] >= merged['基准因子日期'])
+        merged['后复权因子'] = np.where(in_range, merged['hfq_factor'] / merged['基准因子'], 1.0)
+
+        merged = merged.sort_values('_row')
+        stock_price_df = stock_price_df.copy()
+        stock_price_df['后复权因子'] = merged['后复权因子'].to_numpy()
         # 计算后复权价格
-        stock_price_df.loc[:, '后复权收盘'] = stock_price_df['收盘'] * stock_price_df['后复权因子']
+        stock_price_df['后复权收盘'] = stock_price_df['收盘'] * stock_price_df['后复权因子']
 
         # 以后复权方式获取价格
         stock_price_df = StockPriceHistory.remove_duplicates(stock_price_df)
@@ -137,43 +236,71 @@ class StockPriceHistory:
         return stock_price_df
 
     # 从akshare查询持仓列表的股价（对于入参stock_trans其实没有特别要求，只需要有["交收日期","证券代码"]即可）
-    def query_ak_for_stocks(self, stock_trans_df, start_date, end_date, adjust_type=AK_ADJUST_NONE):
-        stock_price_df = pd.DataFrame()
-        # 保存港股通结算汇率
-        exchange_rate_df = self.cache_exchange_rate_from_ak()
+    # 每个证券代码只请求 需要的区间 - 覆盖清单中已有区间 的差集，
+    # 所有请求交给有界线程池并发执行，按接口限速，失败的请求退避重试
+    def query_ak_for_stocks(self, stock_trans_df, start_date, end_date, adjust_type=AK_ADJUST_NONE, max_workers=4):
+        coverage = self.get_price_coverage()
         # 切分为100日一份，以免冗余数据过多
         date_ranges = self.split_date_ranges(start_date, end_date)
-        # 开始循环
-        failed_codes = []
+        needed_ranges = {}
         for range_start, range_end in date_ranges:
             stock_df_range = stock_trans_df[
                 (stock_trans_df['交收日期'] >= range_start) & (stock_trans_df['交收日期'] <= range_end)]
             codes = stock_df_range['证券代码'].unique()
-            print(f"{range_start.strftime('%Y%m%d')}, {range_end.strftime('%Y%m%d'):}")
-            print(codes)
             for stock_code in codes:
-                stock_hist_df = self.query_akshare(stock_code, range_start, range_end, exchange_rate_df, adjust_type)
-                if stock_hist_df is None:
-                    failed_codes.append(stock_code)
-                else:  # 将查询数据拼接
-                    stock_price_df = pd.concat([stock_price_df, stock_hist_df])
+                needed_ranges.setdefault(stock_code, []).append((range_start, range_end))
+
+        # 对所有证券代码一次性做市场分类，用于按市场分派接口和限速
+        markets = dict(zip(needed_ranges, SecurityClassifier.classify(list(needed_ranges))))
+        # 只有需要查询港股时才加载港股通结算汇率（本地缓存，过期才刷新）
+        exchange_rate_df = self.get_exchange_rate_df() if '港股股票' in markets.values() else None
+        tasks = []
+        for stock_code, ranges in needed_ranges.items():
+            market = markets[stock_code]
+            for needed_start, needed_end in PriceCoverage.merge_intervals(ranges):
+                for range_start, range_end in coverage.missing(stock_code, needed_start, needed_end):
+                    print(f"{stock_code}: {range_start.strftime('%Y%m%d')}, {range_end.strftime('%Y%m%d')}")
+                    tasks.append(FetchTask(key=stock_code, endpoint=AK_ENDPOINTS.get(market, market),
+                                           func=self.fetch_akshare,
+                                           kwargs={'stock_code': stock_code, 'from_date': range_start,
+                                                   'to_date': range_end, 'exchange_rate_df': exchange_rate_df,
+                                                   'adjust_type': adjust_type, 'market': market}))
+        print(f"共{len(needed_ranges)}个证券代码，需要请求{len(tasks)}个未覆盖的日期区间")
+
+        results, failed_codes = FetchExecutor(max_workers=max_workers, rate_limits=AK_RATE_LIMITS).run(tasks)
+        # 查询结果先收集到列表里，最后只拼接一次
+        stock_hist_dfs = []
+        for task, stock_hist_df in zip(tasks, results):
+            if stock_hist_df is None:
+                if task.key not in failed_codes:
+                    failed_codes.append(task.key)
+            elif len(stock_hist_df) > 0:
+                stock_hist_dfs.append(stock_hist_df)
+        if stock_hist_dfs:
+            stock_price_df = pd.concat(stock_hist_dfs, ignore_index=True)
+        else:
+            stock_price_df = pd.DataFrame(columns=['日期', '收盘', '证券代码'])
         # 只保留需要的三列
         stock_price_df = stock_price_df[['日期', '收盘', '证券代码']]
         # 将"日期"列转换为日期类型
         stock_price_df['日期'] = pd.to_datetime(stock_price_df['日期'])
+        stock_price_df = self.remove_duplicates(stock_price_df)
 
-        # 如果磁盘上有缓存文件，先把缓存加载（最后会删除去重）
-        if os.path.exists(ALL_STOCK_HIST_DF_PKL):
-            all_stock_hist_df = self.load_from_local(ALL_STOCK_HIST_DF_PKL)
-            all_stock_hist_df = pd.concat([all_stock_hist_df, stock_price_df])
-        else:
-            all_stock_hist_df = stock_price_df
+        # 追加到本地价格存储的日志中，再在后台把日志压缩进涉及到的 年份/证券代码 分区
+        self.get_price_store().write(stock_price_df)
+        self.price_store.compact_in_background()
 
-        all_stock_hist_df = self.remove_duplicates(all_stock_hist_df)
-        # 保存到本地
-        self.save_to_local(all_stock_hist_df, ALL_STOCK_HIST_DF_PKL)
+        # 请求到数据的区间记入覆盖清单，只记到实际返回的最后一个日期（今天的收盘价可能还不完整，最多只记到昨天）；
+        # 返回空数据的区间（接口偶发异常、数据还没有发布）不记入，下次还会请求
+        covered_until = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+        for task, stock_hist_df in zip(tasks, results):
+            if stock_hist_df is None or len(stock_hist_df) == 0:
+                continue
+            last_returned = pd.to_datetime(stock_hist_df['日期']).max()
+            coverage.add(task.key, task.kwargs['from_date'], min(task.kwargs['to_date'], last_returned, covered_until))
+        coverage.save()
 
-        return all_stock_hist_df, failed_codes
+        return stock_price_df, failed_codes
 
     @staticmethod
     # 检查stock_price_df中的重复数据，和收盘价格为NA的数据，并删除
@@ -195,51 +322,56 @@ class StockPriceHistory:
         stock_price_df.reset_index(drop=True, inplace=True)
         return stock_price_df
 
-    # 调用akshare接口（东财接口）
+    # 通过行情数据源调用akshare接口（东财接口），出错时打印错误并返回None
     def query_akshare(self, stock_code, from_date, to_date, exchange_rate_df, adjust_type=AK_ADJUST_NONE):
+        try:
+            return self.fetch_akshare(stock_code, from_date, to_date, exchange_rate_df, adjust_type)
+        except Exception as e:
+            print(f"Failed to fetch data for stock code: {stock_code}. Error: {e}")
+            return None
+
+    # 按市场分派到不同的akshare接口，出错时直接抛出异常（由调用方决定是否重试）
+    def fetch_akshare(self, stock_code, from_date, to_date, exchange_rate_df, adjust_type=AK_ADJUST_NONE,
+                      market=None):
         stock_hist_df = None
-        ignore=False
-        market = self.judge_stock_market(stock_code)
+        ignore = False
+        if market is None:
+            market = self.judge_stock_market(stock_code)
+        provider = get_provider()
         # 转换为akshare所需的字符串形式
         start_date = from_date.strftime('%Y%m%d')
         end_date = to_date.strftime('%Y%m%d')
-        try:
-            if market == '上海A股' or market == '深圳A股':
-                stock_hist_df = ak.stock_zh_a_hist(symbol=stock_code, period="daily", start_date=start_date,
-                                                   end_date=end_date, adjust=adjust_type)
-            elif market == '分级基金':
-                stock_hist_df = FundDataHandler.grade_fund_hist(stock_code=stock_code, start_date=start_date,
-                                                                end_date=end_date)
-            elif market == 'ETF基金':
-                stock_hist_df = FundDataHandler.etf_fund_hist(stock_code=stock_code, start_date=start_date,
-                                                              end_date=end_date)
-            elif market == 'B股股票':
-                stock_hist_df = ak.stock_zh_b_daily(symbol='sh' + stock_code, start_date=start_date,
-                                                    end_date=end_date, adjust=adjust_type)
-                stock_hist_df.rename(columns={'date': '日期', 'close': '收盘'}, inplace=True)
-                stock_hist_df = stock_hist_df[['日期', '收盘']]
-            elif market == '港股股票':
-                stock_hist_df = ak.stock_hk_hist(symbol=stock_code, period="daily", start_date=start_date,
-                                                 end_date=end_date, adjust=adjust_type)
-                stock_hist_df['日期'] = pd.to_datetime(stock_hist_df['日期'])
-                stock_hist_df = pd.merge(stock_hist_df, exchange_rate_df, how='left', on=['日期'])
-                stock_hist_df['收盘'] = stock_hist_df['收盘'] * stock_hist_df['卖出结算汇兑比率']
-                stock_hist_df = stock_hist_df[['日期', '收盘']]
-                # .drop(['买入结算汇兑比率','卖出结算汇兑比率','货币种类'], axis=1, inplace=True)
-            elif market == '香港指数':
-                stock_hist_df = FundDataHandler.hk_index_hist(symbol= stock_code, start_date=start_date,
-                                                              end_date=end_date)
-            elif market == 'A股新股':
-                ignore = True  # ignore 新股
-        except Exception as e:
-            print(f"Failed to fetch data for stock code: {stock_code}. Error: {e}")
-        if ignore == True :
+        if market == '上海A股' or market == '深圳A股':
+            stock_hist_df = provider.fetch('stock_zh_a_hist', symbol=stock_code, period="daily",
+                                           start_date=start_date, end_date=end_date, adjust=adjust_type)
+        elif market == '分级基金':
+            stock_hist_df = FundDataHandler.grade_fund_hist(stock_code=stock_code, start_date=start_date,
+                                                            end_date=end_date)
+        elif market == 'ETF基金':
+            stock_hist_df = FundDataHandler.etf_fund_hist(stock_code=stock_code, start_date=start_date,
+                                                          end_date=end_date)
+        elif market == 'B股股票':
+            stock_hist_df = provider.fetch('stock_zh_b_daily', symbol='sh' + stock_code, start_date=start_date,
+                                           end_date=end_date, adjust=adjust_type)
+            stock_hist_df.rename(columns={'date': '日期', 'close': '收盘'}, inplace=True)
+            stock_hist_df = stock_hist_df[['日期', '收盘']]
+        elif market == '港股股票':
+            stock_hist_df = provider.fetch('stock_hk_hist', symbol=stock_code, period="daily",
+                                           start_date=start_date, end_date=end_date, adjust=adjust_type)
+            stock_hist_df = self.convert_hk_close_to_cny(stock_hist_df, exchange_rate_df)
+            stock_hist_df = stock_hist_df[['日期', '收盘']]
+        elif market == '香港指数':
+            stock_hist_df = FundDataHandler.hk_index_hist(symbol=stock_code, start_date=start_date,
+                                                          end_date=end_date)
+        elif market == 'A股新股':
+            ignore = True  # ignore 新股
+        if ignore:
             stock_hist_df = pd.DataFrame()  # ignore
         elif stock_hist_df is not None:
-                if len(stock_hist_df) < 1:
-                    print(f"Empty data returned for stock code: {stock_code}")
-                else:
-                    stock_hist_df['证券代码'] = stock_code
+            if len(stock_hist_df) < 1:
+                print(f"Empty data returned for stock code: {stock_code}")
+            else:
+                stock_hist_df['证券代码'] = stock_code
         return stock_hist_df
 
     # 将日期区间按照bin_size(缺省100天)间隔切分为左闭右闭的子区间，这样每次批量获取的收盘价数据不至于冗余太多
@@ -259,69 +391,98 @@ class StockPriceHistory:
     def judge_stock_market(code):
         if not isinstance(code, str) or len(code) < 1:
             raise ValueError("Invalid input: code must be a non-empty string")
+        return SecurityClassifier.judge(code)
 
-        if FundDataHandler.is_etf_fund(code):
-            return 'ETF基金'
-        if FundDataHandler.is_grade_fund(code):
-            return '分级基金'
-        if FundDataHandler.is_hk_index(code):
-            return '香港指数'
-
-        if len(code) < 5:
-            return '未知类型'
-
-        if len(code) == 5:
-            return '港股股票'
-        elif code.startswith('6'):
-            return '上海A股'
-        elif code.startswith('00') or code.startswith('30'):
-            return '深圳A股'
-        elif code.startswith('900'):
-            return 'B股股票'
-        elif code.startswith('7'):
-            return 'A股新股'
+    # 调用akshare接口（新浪接口）获取目标股票的后复权因子，增量模式：
+    # 只刷新新持有的证券代码，和最后一次刷新之后价格存储里又有了这个代码自己的新收盘价的证券代码（新的交易日可能有新的除权除息），
+    # 并发抓取；没有新收盘价的证券代码不产生任何请求。价格存储中没有某代码的收盘价时，对这个代码退回到按max_age判断是否过期
+    @staticmethod
+    def cache_hfq_factors(stockcodes, max_age=HFQ_FACTORS_MAX_AGE, max_workers=4, latest_price_dates=None):
+        now = pd.Timestamp.now()
+        stockcodes = list(pd.unique(pd.Series(list(stockcodes), dtype=object)))
+        if latest_price_dates is None:
+            latest_price_dates = StockPriceStore().max_dates(stockcodes)
+        hfq_meta = StockPriceHistory.load_hfq_factors_meta()
+        if os.path.exists(ALL_HFQ_FACTORS_PKL):
+            all_hfq_factors = pd.read_pickle(ALL_HFQ_FACTORS_PKL)
         else:
-            return '未知类型'
+            all_hfq_factors = pd.DataFrame(columns=['日期', 'hfq_factor', '证券代码'])
+
+        def is_stale(stock_code):
+            if stock_code not in hfq_meta.index:
+                return True
+            refreshed_at = hfq_meta.loc[stock_code, '最后刷新时间']
+            latest_price_date = latest_price_dates.get(stock_code)
+            if latest_price_date is None or pd.isna(latest_price_date):
+                return now - refreshed_at > max_age
+            return refreshed_at.normalize() < latest_price_date
+
+        stale_codes = [stock_code for stock_code in stockcodes if is_stale(stock_code)]
+        if not stale_codes:
+            print("所有证券代码的后复权因子都是最新的，无需刷新")
+            return all_hfq_factors
+        print(f"需要刷新后复权因子的证券代码：{stale_codes}")
+
+        markets = SecurityClassifier.classify(stale_codes)
+        tasks = []
+        for stock_code, market in zip(stale_codes, markets):
+            tasks.append(FetchTask(key=stock_code, endpoint=AK_HFQ_ENDPOINTS.get(market, market),
+                                   func=StockPriceHistory.fetch_hfq_factors,
+                                   kwargs={'stock_code': stock_code, 'market': market}))
+        results, failed_codes = FetchExecutor(max_workers=max_workers, rate_limits=AK_RATE_LIMITS).run(tasks)
+
+        refreshed_codes = [task.key for task, df_hfq_factors in zip(tasks, results) if df_hfq_factors is not None]
+        new_factors = [df_hfq_factors for df_hfq_factors in results
+                       if df_hfq_factors is not None and len(df_hfq_factors) > 0]
+        # 新浪接口返回的是完整的因子历史，刷新过的证券代码整体替换原有的因子数据
+        all_hfq_factors = all_hfq_factors[~all_hfq_factors['证券代码'].isin(refreshed_codes)]
+        if new_factors:
+            if len(all_hfq_factors) > 0:
+                new_factors = [all_hfq_factors] + new_factors
+            all_hfq_factors = pd.concat(new_factors, ignore_index=True)
+        all_hfq_factors = all_hfq_factors.drop_duplicates(subset=['证券代码', '日期'], keep='last')
+
+        # 更新每个刷新过的证券代码的刷新时间
+        for stock_code in refreshed_codes:
+            hfq_meta.loc[stock_code, '最后刷新时间'] = now
+
+        # 保存到本地
+        all_hfq_factors.to_pickle(ALL_HFQ_FACTORS_PKL)
+        hfq_meta.to_pickle(ALL_HFQ_FACTORS_META_PKL)
+        if failed_codes:
+            print(f"以下证券代码的后复权因子获取失败，下次运行时会重试：{failed_codes}")
+        return all_hfq_factors
 
-    # 调用akshare接口（新浪接口）获取目标股票的后复权因子
+    # 获取单只股票的完整后复权因子历史，出错时直接抛出异常（由调用方决定是否重试）
     @staticmethod
-    def cache_hfq_factors(stockcodes):
-        all_hfq_factors = pd.DataFrame()
-        df_hfq_factors = None
-        for stock_code in stockcodes:
+    def fetch_hfq_factors(stock_code, market=None):
+        if market is None:
             market = StockPriceHistory.judge_stock_market(stock_code)
-            try:
-                if market == '上海A股':
-                    df_hfq_factors = ak.stock_zh_a_daily(symbol='sh' + stock_code, adjust=AK_ADJUST_HFQ)
-                elif market == '深圳A股':
-                    df_hfq_factors = ak.stock_zh_a_daily(symbol='sz' + stock_code, adjust=AK_ADJUST_HFQ)
-                elif market == 'B股股票':
-                    df_hfq_factors = ak.stock_zh_b_daily(symbol='sh' + stock_code, adjust=AK_ADJUST_HFQ)
-                elif market == '港股股票':
-                    df_hfq_factors = ak.stock_hk_daily(symbol=stock_code, adjust=AK_ADJUST_HFQ)
-                elif market == 'A股新股':
-                    df_hfq_factors = pd.DataFrame()  # ignore 新股
-                else:  # Default to A股股票
-                    df_hfq_factors = pd.DataFrame()  # ignore
-            except Exception as e:
-                print(f"Failed to fetch data for stock code: {stock_code}. Error: {e}")
-            df_hfq_factors['证券代码'] = stock_code
-            all_hfq_factors = pd.concat([all_hfq_factors, df_hfq_factors])
+        provider = get_provider()
+        if market == '上海A股':
+            df_hfq_factors = provider.fetch('stock_zh_a_daily', symbol='sh' + stock_code, adjust=AK_ADJUST_HFQ)
+        elif market == '深圳A股':
+            df_hfq_factors = provider.fetch('stock_zh_a_daily', symbol='sz' + stock_code, adjust=AK_ADJUST_HFQ)
+        elif market == 'B股股票':
+            df_hfq_factors = provider.fetch('stock_zh_b_daily', symbol='sh' + stock_code, adjust=AK_ADJUST_HFQ)
+        elif market == '港股股票':
+            df_hfq_factors = provider.fetch('stock_hk_daily', symbol=stock_code, adjust=AK_ADJUST_HFQ)
+        else:  # 新股等其他类型没有后复权因子，忽略
+            df_hfq_factors = pd.DataFrame(columns=['date', 'hfq_factor'])
         # 数据格式为： date hfq_factor   cash  ，先改名
-        all_hfq_factors.rename(columns={'date': '日期'}, inplace=True)
+        df_hfq_factors = df_hfq_factors.rename(columns={'date': '日期'})
         # 将日期格式更新
-        all_hfq_factors['日期'] = pd.to_datetime(all_hfq_factors['日期'])
-
-        # 如果磁盘上有缓存文件，先把缓存加载（最后会删除去重）
-        if os.path.exists(ALL_HFQ_FACTORS_PKL):
-            history_df = pd.read_pickle(ALL_HFQ_FACTORS_PKL)
-            all_hfq_factors = pd.concat([all_hfq_factors, history_df])
-
-        all_hfq_factors = StockPriceHistory.remove_duplicates(all_hfq_factors)
+        df_hfq_factors['日期'] = pd.to_datetime(df_hfq_factors['日期'])
+        df_hfq_factors['证券代码'] = stock_code
+        return df_hfq_factors
 
-        # 保存到本地
-        all_hfq_factors.to_pickle(ALL_HFQ_FACTORS_PKL)
-        return all_hfq_factors
+    # 加载后复权因子的刷新记录，index为证券代码
+    @staticmethod
+    def load_hfq_factors_meta():
+        if os.path.exists(ALL_HFQ_FACTORS_META_PKL):
+            return pd.read_pickle(ALL_HFQ_FACTORS_META_PKL)[['最后刷新时间']]
+        return pd.DataFrame({'最后刷新时间': pd.Series(dtype='datetime64[ns]')},
+                            index=pd.Index([], name='证券代码', dtype=object))
 
     @staticmethod
     def save_to_local(data_frame, file_name):
@@ -331,14 +492,41 @@ class StockPriceHistory:
     def load_from_local(file_name):
         return pd.read_pickle(file_name)
 
+    # 获取沪港通结算汇率表：本地汇率表已经有今天（含）之后适用的汇率，或者文件在有效期内，直接使用；否则从akshare刷新
+    @staticmethod
+    def get_exchange_rate_df(max_age=HGT_EXCHANGE_RATE_MAX_AGE):
+        if os.path.exists(HGT_EXCHANGE_RATE_FILE):
+            exchange_rate_df = StockPriceHistory.load_exchange_rate_df()
+            if exchange_rate_df['日期'].max() >= pd.Timestamp.today().normalize() or \
+                    time.time() - os.path.getmtime(HGT_EXCHANGE_RATE_FILE) < max_age.total_seconds():
+                return exchange_rate_df
+        return StockPriceHistory.cache_exchange_rate_from_ak()
+
     @staticmethod
     def cache_exchange_rate_from_ak():
-        # 获取所有沪港通结算汇率数据并保存到文件里
-        stock_sgt_settlement_exchange_rate_sse_df = ak.stock_sgt_settlement_exchange_rate_sse()
+        # akshare的结算汇率接口没有日期参数，每次都返回完整历史；
+        # 只把本地汇率表最后日期（含，当天的汇率可能被更正）之后的记录追加到本地汇率表
+        try:
+            stock_sgt_settlement_exchange_rate_sse_df = get_provider().fetch(
+                'stock_sgt_settlement_exchange_rate_sse')
+        except Exception as e:
+            if os.path.exists(HGT_EXCHANGE_RATE_FILE):
+                print(f"Failed to refresh exchange rate, use local cache instead. Error: {e}")
+                return StockPriceHistory.load_exchange_rate_df()
+            raise
         stock_sgt_settlement_exchange_rate_sse_df.rename(columns={'适用日期': '日期'}, inplace=True)
         stock_sgt_settlement_exchange_rate_sse_df['日期'] = pd.to_datetime(
             stock_sgt_settlement_exchange_rate_sse_df['日期'])
-        # print(stock_sgt_settlement_exchange_rate_sse_df)
+        if os.path.exists(HGT_EXCHANGE_RATE_FILE):
+            cached_df = StockPriceHistory.load_exchange_rate_df()
+            max_date = cached_df['日期'].max()
+            if pd.notna(max_date):
+                stock_sgt_settlement_exchange_rate_sse_df = stock_sgt_settlement_exchange_rate_sse_df[
+                    stock_sgt_settlement_exchange_rate_sse_df['日期'] >= max_date]
+            stock_sgt_settlement_exchange_rate_sse_df = pd.concat(
+                [cached_df, stock_sgt_settlement_exchange_rate_sse_df], ignore_index=True)
+        stock_sgt_settlement_exchange_rate_sse_df = stock_sgt_settlement_exchange_rate_sse_df.drop_duplicates(
+            subset=['日期'], keep='last').sort_values('日期').reset_index(drop=True)
         stock_sgt_settlement_exchange_rate_sse_df.to_pickle(HGT_EXCHANGE_RATE_FILE)
         return stock_sgt_settlement_exchange_rate_sse_df
 
@@ -346,40 +534,63 @@ class StockPriceHistory:
     def load_exchange_rate_df():
         return pd.read_pickle(HGT_EXCHANGE_RATE_FILE)
 
+    # 将港币收盘价批量转换为人民币：按日期做as-of join，当天没有公布结算汇率时使用之前最近一天的汇率
+    @staticmethod
+    def convert_hk_close_to_cny(stock_hist_df, exchange_rate_df, close_column='收盘'):
+        rates = exchange_rate_df[['日期', '卖出结算汇兑比率']].dropna().copy()
+        rates['日期'] = pd.to_datetime(rates['日期']).astype('datetime64[ns]')
+        rates = rates.sort_values('日期')
+
+        stock_hist_df = stock_hist_df.copy()
+        stock_hist_df['日期'] = pd.to_datetime(stock_hist_df['日期']).astype('datetime64[ns]')
+        stock_hist_df['_row'] = np.arange(len(stock_hist_df))
+        merged = pd.merge_asof(stock_hist_df.sort_values('日期'), rates, on='日期', direction='backward')
+        merged = merged.sort_values('_row').drop(columns=['_row']).reset_index(drop=True)
+        merged[close_column] = merged[close_column] * merged['卖出结算汇兑比率']
+        return merged.drop(columns=['卖出结算汇兑比率'])
+
     @staticmethod
     def cache_trade_dates():
-        tool_trade_date_hist_sina_df = ak.tool_trade_date_hist_sina()
+        tool_trade_date_hist_sina_df = get_provider().fetch('tool_trade_date_hist_sina')
         tool_trade_date_hist_sina_df['trade_date'] = pd.to_datetime(tool_trade_date_hist_sina_df['trade_date'])
         print(tool_trade_date_hist_sina_df)
         tool_trade_date_hist_sina_df.to_pickle(TRADE_DATES)
+        # 进程内已经加载的交易日历改用新的文件
+        TradeCalendar.instance(TRADE_DATES).reload()
 
+    # 交易日的DataFrame（trade_date列），需要做日期运算时直接用 get_trade_calendar()
     @staticmethod
     def load_trade_dates():
-        return pd.read_pickle(TRADE_DATES)
+        return StockPriceHistory.get_trade_calendar().to_frame()
+
+    # 进程内共享的交易日历，只加载一次，cache_trade_dates 更新 trade_dates.pkl 后会重新加载
+    @staticmethod
+    def get_trade_calendar():
+        return TradeCalendar.instance(TRADE_DATES)
 
 
 def run_update_ak():
     stock_price = StockPriceHistory()
 
     start_date = pd.to_datetime('20070501', format='%Y%m%d')
-    # 如果磁盘上有缓存文件，先把缓存加载，用于确定继续的start_date
-    if os.path.exists(ALL_STOCK_HIST_DF_PKL):
-        all_stock_hist_df = stock_price.load_from_local(ALL_STOCK_HIST_DF_PKL)
-        start_date = all_stock_hist_df['日期'].max()
-        # 将开始日期往前推两个月以预留缓冲时间
-        start_date -= pd.DateOffset(months=2)
+    # 如果本地已有价格存储，用最新的日期确定继续的start_date（只需读取最后一个年份分区的日期列）
+    # 不需要再往前预留缓冲时间：覆盖清单保证只请求每个证券代码还没有抓取过的日期区间
+    max_date = stock_price.get_price_store().max_date()
+    if max_date is not None:
+        start_date = max_date
 
     df, failed = stock_price.fetch_close_price_from_ak(start_date)
     print(df)
     print(f"failed codes: {failed}")
+    # 等后台压缩完成再退出
+    stock_price.get_price_store().join_compaction()
 
 
 # 纯粹测试函数
 def get_hfq_prices():
     stock_price = StockPriceHistory()
     start_date = pd.to_datetime('20191124', format='%Y%m%d')
-    stock_price_df = stock_price.get_stock_price_df(start_date)
-    stock_price_df = stock_price_df[stock_price_df['证券代码'] == '002515']
+    stock_price_df = stock_price.get_stock_price_df(start_date, codes=['002515'])
     hfq_df = pd.read_pickle(ALL_HFQ_FACTORS_PKL)
     hfq_df = hfq_df[hfq_df['证券代码'] == '002515']
     result = stock_price.cal_hfq_price(stock_price_df, hfq_df, start_date)
@@ -0,0 +1,270 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+PRICE_STORE_DIR = 'stock/price_store'  # 按 年份/证券代码 分区的收盘价列式存储
+PARTITION_SUFFIX = '.parquet'
+APPEND_LOG_DIR = '_log'  # 分区存储下的追加日志目录，新写入的收盘价先追加到这里，压缩时再合并进分区
+REVISION_DIR = '_revisions'  # 每次压缩时新增或修正了收盘价的证券代码和最早日期，供增量估值找出需要重新估值的日子
+
+
+# 收盘价的列式分区存储，替代原来的 all_stock_hist_df.pkl 单文件
+# 目录结构为 <root>/<年份>/<证券代码>.parquet，每个分区只保存 ['日期', '收盘', '证券代码'] 三列
+# 读取时按日期和证券代码下推过滤：只打开相关年份、相关代码的分区文件，分区内再按日期过滤
+# 写入时只把新数据追加到 <root>/_log 下的一个日志文件，不读取也不重写已有数据；
+# 压缩（可以在后台线程运行）把日志合并进涉及到的分区。
+# 同一个(证券代码, 日期)出现多次时以最后写入的为准（例如数据源修正了收盘价）
+class StockPriceStore:
+    COLUMNS = ['日期', '收盘', '证券代码']
+    KEY_COLUMNS = ['证券代码', '日期']
+    _locks = {}  # 每个存储目录一把锁，保证读取和压缩不会交错
+    _locks_guard = threading.Lock()
+
+    def __init__(self, root=PRICE_STORE_DIR):
+        self.root = root
+        self.compaction_thread = None  # compact_in_background 启动的后台压缩线程
+        self.compaction_error = None  # 后台压缩抛出的异常，join_compaction 时重新抛出
+        with StockPriceStore._locks_guard:
+            self.lock = StockPriceStore._locks.setdefault(os.path.abspath(root), threading.RLock())
+
+    @property
+    def log_dir(self):
+        return os.path.join(self.root, APPEND_LOG_DIR)
+
+    @property
+    def revision_dir(self):
+        return os.path.join(self.root, REVISION_DIR)
+
+    def partition_path(self, year, stock_code):
+        return os.path.join(self.root, str(year), f'{stock_code}{PARTITION_SUFFIX}')
+
+    def is_empty(self):
+        return len(self.list_years()) == 0 and len(self.list_log_files()) == 0
+
+    # 按写入顺序列出还没有被压缩的追加日志文件
+    def list_log_files(self):
+        if not os.path.exists(self.log_dir):
+            return []
+        return sorted(os.path.join(self.log_dir, file_name) for file_name in os.listdir(self.log_dir)
+                      if file_name.endswith(PARTITION_SUFFIX))
+
+    # 列出存储中已有的年份分区
+    def list_years(self):
+        if not os.path.exists(self.root):
+            return []
+        return sorted(int(name) for name in os.listdir(self.root) if name.isdigit())
+
+    # 根据日期区间和证券代码列出需要读取的分区 (年份, 证券代码)
+    def list_partitions(self, start_date=None, end_date=None, codes=None):
+        start_year = pd.to_datetime(start_date).year if start_date is not None else None
+        end_year = pd.to_datetime(end_date).year if end_date is not None else None
+        partitions = []
+        for year in self.list_years():
+            if (start_year is not None and year < start_year) or (end_year is not None and year > end_year):
+                continue
+            if codes is None:
+                year_dir = os.path.join(self.root, str(year))
+                year_codes = sorted(file_name[:-len(PARTITION_SUFFIX)] for file_name in os.listdir(year_dir)
+                                    if file_name.endswith(PARTITION_SUFFIX))
+            else:
+                year_codes = [code for code in codes if os.path.exists(self.partition_path(year, code))]
+            partitions.extend((year, code) for code in year_codes)
+        return partitions
+
+    # 读取收盘价，start_date/end_date 为左闭右闭区间，codes 为空时读取全部证券
+    def read(self, start_date=None, end_date=None, codes=None):
+        if codes is not None:
+            codes = [str(code) for code in pd.unique(pd.Series(list(codes), dtype=object))]
+        filters = []
+        if start_date is not None:
+            filters.append(('日期', '>=', pd.to_datetime(start_date)))
+        if end_date is not None:
+            filters.append(('日期', '<=', pd.to_datetime(end_date)))
+
+        with self.lock:
+            frames = [pd.read_parquet(self.partition_path(year, code), filters=filters or None)
+                      for year, code in self.list_partitions(start_date, end_date, codes)]
+            # 还没有压缩的日志排在分区数据之后，去重时覆盖分区中的旧值
+            log_filters = filters + ([('证券代码', 'in', codes)] if codes is not None else [])
+            log_frames = [pd.read_parquet(log_file, filters=log_filters or None)
+                          for log_file in self.list_log_files()]
+        frames = [frame for frame in frames if len(frame) > 0]
+        log_frames = [frame for frame in log_frames if len(frame) > 0]
+        if not frames and not log_frames:
+            return self.empty_frame()
+        price_df = pd.concat(frames + log_frames, ignore_index=True)
+        if log_frames:
+            price_df = price_df.drop_duplicates(subset=self.KEY_COLUMNS, keep='last').reset_index(drop=True)
+        return price_df
+
+    # 写入一批收盘价：只追加一个日志文件，代价与本批数据量成正比
+    def write(self, price_df):
+        price_df = self.normalize(price_df)
+        if len(price_df) == 0:
+            return None
+        price_df = price_df.drop_duplicates(subset=self.KEY_COLUMNS, keep='last')
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_file = os.path.join(self.log_dir, f'{time.time_ns()}-{os.getpid()}{PARTITION_SUFFIX}')
+        self.write_parquet(price_df, log_file)
+        return log_file
+
+    # 把追加日志合并进涉及到的分区，只重写这些分区，然后删除已合并的日志
+    def compact(self):
+        with self.lock:
+            log_files = self.list_log_files()
+            if not log_files:
+                return []
+            log_df = pd.concat([pd.read_parquet(log_file) for log_file in log_files], ignore_index=True)
+            log_df = log_df.drop_duplicates(subset=self.KEY_COLUMNS, keep='last')
+            merged = []  # (年份, 证券代码, 合并后的分区数据)
+            revisions = []  # (证券代码, 这个分区中新增或修正了收盘价的最早日期)
+            for (year, stock_code), partition_df in log_df.groupby([log_df['日期'].dt.year, '证券代码']):
+                path = self.partition_path(year, stock_code)
+                if os.path.exists(path):
+                    existing_df = pd.read_parquet(path)
+                    # 与分区中已有的收盘价比较，只有新增的日期和收盘价变了的日期才算修正
+                    compared = partition_df.merge(existing_df[['日期', '收盘']], on='日期', how='left',
+                                                  suffixes=('', '_旧'))
+                    revised_dates = compared.loc[compared['收盘'] != compared['收盘_旧'], '日期']
+                    partition_df = pd.concat([existing_df, partition_df], ignore_index=True)
+                else:
+                    revised_dates = partition_df['日期']
+                if len(revised_dates) > 0:
+                    revisions.append((stock_code, revised_dates.min()))
+                partition_df = partition_df.drop_duplicates(subset=self.KEY_COLUMNS, keep='last')
+                merged.append((year, stock_code, partition_df.sort_values('日期').reset_index(drop=True)))
+            # 先保存修正记录再重写分区：中途退出时日志还在，下次压缩会重新合并，修正记录也不会丢失
+            self.save_revisions(revisions)
+            touched = []
+            for year, stock_code, partition_df in merged:
+                path = self.partition_path(year, stock_code)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.write_parquet(partition_df, path)
+                touched.append((year, stock_code))
+            for log_file in log_files:
+                os.remove(log_file)
+        print(f"价格存储压缩完成，合并了{len(log_files)}个日志文件，重写了{len(touched)}个分区")
+        return touched
+
+    # 一次压缩的修正记录保存为 <root>/_revisions 下的一个文件
+    def save_revisions(self, revisions):
+        if not revisions:
+            return None
+        revision_df = pd.DataFrame(revisions, columns=['证券代码', '日期']).groupby('证券代码', as_index=False).min()
+        os.makedirs(self.revision_dir, exist_ok=True)
+        revision_file = os.path.join(self.revision_dir, f'{time.time_ns()}-{os.getpid()}{PARTITION_SUFFIX}')
+        self.write_parquet(revision_df, revision_file)
+        return revision_file
+
+    # 先写临时文件再改名，中途退出不会留下不完整的parquet文件
+    @staticmethod
+    def write_parquet(frame, path):
+        frame.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+    # 还没有被处理的修正记录文件
+    def list_revision_files(self):
+        if not os.path.exists(self.revision_dir):
+            return []
+        return sorted(os.path.join(self.revision_dir, file_name) for file_name in os.listdir(self.revision_dir)
+                      if file_name.endswith(PARTITION_SUFFIX))
+
+    # 读取修正记录，每个证券代码一行：收盘价被新增或修正的最早日期
+    def read_revisions(self, revision_files=None):
+        revision_files = self.list_revision_files() if revision_files is None else revision_files
+        frames = [pd.read_parquet(revision_file) for revision_file in revision_files]
+        if not frames:
+            return pd.DataFrame({'证券代码': pd.Series(dtype=object), '日期': pd.Series(dtype='datetime64[ns]')})
+        return pd.concat(frames, ignore_index=True).groupby('证券代码', as_index=False)['日期'].min()
+
+    # 删除已经处理过的修正记录文件
+    def clear_revisions(self, revision_files):
+        for revision_file in revision_files:
+            if os.path.exists(revision_file):
+                os.remove(revision_file)
+
+    # 在后台线程中压缩，返回线程对象。
+    # 守护线程不会阻止进程退出：分区都是整体替换的，没完成的压缩下次会从还在的日志重新开始；
+    # 需要等压缩完成时调用 join_compaction
+    def compact_in_background(self):
+        self.compaction_error = None
+        self.compaction_thread = threading.Thread(target=self._compact_logging_errors, name='price-store-compaction',
+                                                  daemon=True)
+        self.compaction_thread.start()
+        return self.compaction_thread
+
+    def _compact_logging_errors(self):
+        try:
+            self.compact()
+        except Exception as e:
+            self.compaction_error = e
+            print(f"价格存储后台压缩失败：{e}")
+
+    # 等待后台压缩完成，压缩失败时抛出压缩时的异常
+    def join_compaction(self, timeout=None):
+        if self.compaction_thread is not None:
+            self.compaction_thread.join(timeout)
+            if self.compaction_thread.is_alive():
+                raise TimeoutError(f"价格存储后台压缩在{timeout}秒内没有完成")
+            self.compaction_thread = None
+        if self.compaction_error is not None:
+            error, self.compaction_error = self.compaction_error, None
+            raise error
+
+    # 存储中最新的收盘价日期（只需要读最后一个年份分区和未压缩日志的日期列）
+    def max_date(self):
+        with self.lock:
+            files = self.list_log_files()
+            years = self.list_years()
+            if years:
+                year_dir = os.path.join(self.root, str(years[-1]))
+                files += [os.path.join(year_dir, file_name) for file_name in os.listdir(year_dir)
+                          if file_name.endswith(PARTITION_SUFFIX)]
+            dates = [pd.read_parquet(file, columns=['日期'])['日期'].max() for file in files]
+        dates = [date for date in dates if pd.notna(date)]
+        return max(dates) if dates else None
+
+    # 每个证券代码在存储中最新的收盘价日期（index为证券代码），只读每个代码最晚的年份分区和未压缩日志的日期列；
+    # 存储中没有收盘价的证券代码不在结果中
+    def max_dates(self, codes):
+        codes = [str(code) for code in pd.unique(pd.Series(list(codes), dtype=object))]
+        latest = {}
+        with self.lock:
+            years = self.list_years()
+            for code in codes:
+                for year in reversed(years):
+                    path = self.partition_path(year, code)
+                    if os.path.exists(path):
+                        latest[code] = pd.read_parquet(path, columns=['日期'])['日期'].max()
+                        break
+            log_frames = [pd.read_parquet(log_file, columns=['证券代码', '日期'], filters=[('证券代码', 'in', codes)])
+                          for log_file in self.list_log_files()]
+        dates = pd.Series(latest, index=pd.Index(list(latest), name='证券代码', dtype=object),
+                          dtype='datetime64[ns]')
+        log_frames = [frame for frame in log_frames if len(frame) > 0]
+        if log_frames:
+            log_dates = pd.concat(log_frames, ignore_index=True).groupby('证券代码')['日期'].max()
+            dates = pd.concat([dates, log_dates]).groupby(level=0).max()
+        return dates.dropna()
+
+    # 从旧的 all_stock_hist_df.pkl 单文件一次性迁移到分区存储
+    def migrate_from_pickle(self, pickle_file):
+        print(f"将{pickle_file}迁移到分区存储{self.root}")
+        self.write(pd.read_pickle(pickle_file))
+        return self.compact()
+
+    @classmethod
+    def normalize(cls, price_df):
+        price_df = price_df[cls.COLUMNS].copy()
+        price_df['日期'] = pd.to_datetime(price_df['日期'])
+        price_df['收盘'] = price_df['收盘'].astype(float)
+        price_df['证券代码'] = price_df['证券代码'].astype(str)
+        return price_df
+
+    @classmethod
+    def empty_frame(cls):
+        return pd.DataFrame({'日期': pd.Series(dtype='datetime64[ns]'),
+                             '收盘': pd.Series(dtype=float),
+                             '证券代码': pd.Series(dtype=object)})
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from gxTransData import SummaryClassifier
+
+
+# 每只股票的交易统计，代替原来逐笔保存买卖记录的 stock_transactions 字典。
+# 回放时按 (证券代码, 摘要) 累加成交数量、发生金额和笔数，表的大小只与股票数和摘要种类有关，与历史长短无关；
+# 最后由这张表一次汇总出 stock_transactions_summary 的每只股票一行
+class StockProfitAccumulator:
+    SUMMARY_COLUMNS = ['证券代码', '证券名称', '买入数量', '卖出数量', '当前持仓股数', '累计买入花费', '累计盈利',
+                       '整体盈利率', '买入明细', '卖出明细']
+
+    def __init__(self):
+        self.names = {}  # 证券代码 -> 第一次交易时的证券名称，按第一次交易的先后排列
+        self.table = None  # index 为 (证券代码, 摘要)，列为 成交数量、发生金额、笔数
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, rows):
+        """
+        累加一批流水
+
+        :param rows: 按回放顺序排列的流水，需要有 证券代码、证券名称、摘要、成交数量变动（带正负号）、资金变动 列
+        """
+        if len(rows) == 0:
+            return
+        rows = rows.astype({'证券代码': object, '摘要': object})
+        for stock_code, stock_name in rows.drop_duplicates('证券代码')[['证券代码', '证券名称']].itertuples(
+                index=False, name=None):
+            self.names.setdefault(stock_code, stock_name)
+        grouped = rows.groupby(['证券代码', '摘要'], sort=False).agg(
+            成交数量=('成交数量变动', 'sum'), 发生金额=('资金变动', 'sum'), 笔数=('资金变动', 'size'))
+        if self.table is not None:
+            # 对齐后的加法会把列变成浮点数：成交数量恢复为两边共同的类型（都是整数时仍为整数，有小数时保留小数），笔数恢复为整数
+            volume_dtype = np.result_type(self.table['成交数量'].dtype, grouped['成交数量'].dtype)
+            grouped = self.table.add(grouped, fill_value=0).astype({'成交数量': volume_dtype, '笔数': 'int64'})
+        self.table = grouped
+
+    # 汇总为每只股票一行：买入/卖出数量、当前持仓股数、累计买入花费、累计盈利、整体盈利率，以及按摘要的买入/卖出明细
+    def summary(self):
+        if self.table is None:
+            return pd.DataFrame(columns=self.SUMMARY_COLUMNS)
+        table = self.table.reset_index()
+        volume_flags = table['摘要'].map(SummaryClassifier.summary_table()['成交数量标志'])
+        codes = pd.Index(list(self.names), name='证券代码')
+        buys = table[volume_flags == 1]
+        sells = table[volume_flags == -1]
+
+        buy_total = buys.groupby('证券代码')['成交数量'].sum().reindex(codes, fill_value=0)
+        sell_total = sells.groupby('证券代码')['成交数量'].sum().reindex(codes, fill_value=0)
+        # 累计买入花费
+        buy_amount_total = buys.groupby('证券代码')['发生金额'].sum().reindex(codes, fill_value=0) * -1
+        profit = table.groupby('证券代码')['发生金额'].sum().reindex(codes, fill_value=0)
+        # 利润率，累计买入花费为0时为0
+        profit_rate = (profit / buy_amount_total.where(buy_amount_total != 0)).fillna(0)
+
+        return pd.DataFrame({
+            '证券代码': codes,
+            '证券名称': [self.names[code] for code in codes],
+            '买入数量': buy_total.to_numpy(),
+            '卖出数量': sell_total.to_numpy(),
+            # 当前持仓数量（自带正负号）
+            '当前持仓股数': (buy_total + sell_total).to_numpy(),
+            '累计买入花费': buy_amount_total.to_numpy(),
+            '累计盈利': profit.to_numpy(),
+            '整体盈利率': profit_rate.to_numpy(),
+            '买入明细': self.details(buys, codes),
+            '卖出明细': self.details(sells, codes),
+        }, columns=self.SUMMARY_COLUMNS)
+
+    # 每只股票按摘要的发生金额合计 {摘要: 发生金额}，摘要按名称排序
+    @staticmethod
+    def details(part, codes):
+        details = {code: {} for code in codes}
+        part = part.sort_values(['证券代码', '摘要'])
+        for stock_code, summary, amount in part[['证券代码', '摘要', '发生金额']].itertuples(index=False, name=None):
+            details[stock_code][summary] = amount
+        return [details[code] for code in codes]
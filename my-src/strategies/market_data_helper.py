@@ -1,6 +1,15 @@
-import akshare as ak
+import os
+
 import pandas as pd
 
+import src_path  # 主目录加入导入路径，必须在导入主目录的模块之前
+from marketDataProvider import get_provider
+from securityClassifier import SecurityClassifier
+from tradeCalendar import TradeCalendar
+
+# 主目录下的交易日文件，不依赖当前目录
+TRADE_DATES_FILE = os.path.join(src_path.MY_SRC_DIR, 'stock', 'trade_dates.pkl')
+
 AK_ADJUST_HFQ = "hfq-factor"  # 后复权模式
 AK_ADJUST_NONE = ""  # 不复权
 
@@ -9,36 +18,27 @@ class MarketDataHelper:
 
     @staticmethod
     def get_trade_dates():
-        return pd.read_pickle('../stock/trade_dates.pkl')
+        return MarketDataHelper.get_trade_calendar().to_frame()
 
+    # 进程内共享的交易日历，只加载一次
     @staticmethod
-    def judge_stock_market(code):
-        if len(code) == 5:
-            return '港股股票'
-        elif code.startswith('6'):
-            return '上海A股'
-        elif code.startswith('00') or code.startswith('30'):
-            return '深圳A股'
-        elif code.startswith('900'):
-            return 'B股股票'
-        elif code.startswith('5'):
-            return 'A股基金'
-        elif code.startswith('7'):
-            return 'A股新股'
-        else:
-            return '未知类型'
+    def get_trade_calendar():
+        return TradeCalendar.instance(TRADE_DATES_FILE)
 
+    @staticmethod
+    def judge_stock_market(code):
+        return SecurityClassifier.judge(code)
 
     @staticmethod
     def query_index_data(index_code, start_date, end_date):
-        price_df = ak.stock_zh_index_daily(symbol=index_code)
+        price_df = get_provider().fetch('stock_zh_index_daily', symbol=index_code)
         price_df['date'] = pd.to_datetime(price_df['date'])
         price_df = price_df[(price_df['date'] >= start_date) & (price_df['date'] <= end_date)]
         price_df = price_df.sort_values('date').set_index('date')
         price_df = price_df.dropna(subset=['high', 'low', 'close'])  # 删除缺失值
         return price_df
 
-    # 调用akshare接口（东财接口）, exchange_rate_df
+    # 通过行情数据源调用akshare接口（东财接口）, exchange_rate_df
     @staticmethod
     def query_akshare(symbol, period, start_date, end_date, adjust=AK_ADJUST_NONE):
         stock_hist_df = None
@@ -46,13 +46,13 @@ class MarketDataHelper:
 
         try:
             if market == '上海A股' or market == '深圳A股':
-                stock_hist_df = ak.stock_zh_a_hist(symbol=symbol, period=period, start_date=start_date,
-                                                   end_date=end_date, adjust=adjust)
+                stock_hist_df = get_provider().fetch('stock_zh_a_hist', symbol=symbol, period=period,
+                                                     start_date=start_date, end_date=end_date, adjust=adjust)
             elif market == 'B股股票':
                 stock_hist_df = pd.DataFrame()  # ignore B股 (新浪接口有问题）
             elif market == '港股股票':
-                stock_hist_df = ak.stock_hk_hist(symbol=symbol, period=period, start_date=start_date,
-                                                 end_date=end_date, adjust=adjust)
+                stock_hist_df = get_provider().fetch('stock_hk_hist', symbol=symbol, period=period,
+                                                     start_date=start_date, end_date=end_date, adjust=adjust)
                 # stock_hist_df['日期'] = pd.to_datetime(stock_hist_df['日期'])
                 # stock_hist_df = pd.merge(stock_hist_df, exchange_rate_df, how='left', on=['日期'])
                 # stock_hist_df['收盘'] = stock_hist_df['收盘'] * stock_hist_df['卖出结算汇兑比率']
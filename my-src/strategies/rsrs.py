@@ -30,13 +30,10 @@ class RSRSStrategy:
         return price_df
 
     def _prepare_warmup_data(self):
-        df_trade_dates = MarketDataHelper.get_trade_dates()
-        nearest_index = df_trade_dates['trade_date'].searchsorted(self.start_date)
-        self.start_date = df_trade_dates.iloc[nearest_index]['trade_date']
-
+        trade_calendar = MarketDataHelper.get_trade_calendar()
         warmup_period = 550
-        warmup_index = max(0, nearest_index - warmup_period)
-        self.warmup_start_date = df_trade_dates.iloc[warmup_index]['trade_date']
+        self.warmup_start_date = trade_calendar.offset(self.start_date, -warmup_period)
+        self.start_date = trade_calendar.offset(self.start_date, 0)
 
         self.warmup_df = MarketDataHelper.query_index_data(self.index_code, self.warmup_start_date, self.start_date)
 
@@ -51,12 +48,9 @@ class RSRSStrategy:
         return [start_date] + list(month_starts)
 
     def get_warmup_data(self, month_start, num_periods):
-        df_trade_dates = MarketDataHelper.get_trade_dates()
-        nearest_end_index = df_trade_dates['trade_date'].searchsorted(month_start)
-        month_start = df_trade_dates.iloc[nearest_end_index]['trade_date']
-
-        start_idx = max(0, nearest_end_index - num_periods)
-        start_date = df_trade_dates.iloc[start_idx]['trade_date']
+        trade_calendar = MarketDataHelper.get_trade_calendar()
+        start_date = trade_calendar.offset(month_start, -num_periods)
+        month_start = trade_calendar.offset(month_start, 0)
         return self.warmup_df[start_date:month_start]
 
     def optimize_parameters_for_month(self, month_start, param_grid):
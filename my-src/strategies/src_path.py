@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 策略脚本在 strategies 目录下运行（python rsrs.py 或 python strategies/rsrs.py），
+# 把主目录（my-src）加入导入路径，策略和主目录共用交易日历、市场分类等模块
+MY_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if MY_SRC_DIR not in sys.path:
+    sys.path.append(MY_SRC_DIR)
@@ -52,15 +52,13 @@ class StrategyPlanner:
     def prepare_backtest_data(self, adjust_type, start_date, end_date, stock_code):
         start_date = pd.to_datetime(start_date)
 
-        df_trade_dates = MarketDataHelper.get_trade_dates()
-        # 找到离start_date最近的index
-        nearest_index = df_trade_dates['trade_date'].searchsorted(start_date)
-        self.start_date = df_trade_dates.iloc[nearest_index]['trade_date']
+        trade_calendar = MarketDataHelper.get_trade_calendar()
+        # 找到离start_date最近的交易日
+        self.start_date = trade_calendar.offset(start_date, 0)
 
         warmup_period = self.lookback_periods + self.slow_window
-        # 从该索引向前移动warmup_period长度
-        warmup_index = max(0, nearest_index - warmup_period)
-        warmup_start_date = df_trade_dates.iloc[warmup_index]['trade_date']
+        # 从该交易日向前移动warmup_period个交易日
+        warmup_start_date = trade_calendar.offset(start_date, -warmup_period)
         self.warmup_start_date = warmup_start_date
 
         # k线数据
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+TRADE_DATES_FILE = 'stock/trade_dates.pkl'  # 交易日（由 StockPriceHistory.cache_trade_dates 生成）
+CHECK_INTERVAL = 60  # 两次检查交易日文件是否被重新生成之间至少间隔的秒数
+
+
+# 进程内共享的交易日历：每个交易日文件在进程内只加载一次，文件被重新生成后在下次使用时自动重新加载
+# （最多每 CHECK_INTERVAL 秒检查一次文件的修改时间），也可以调用 reload() 立即重新加载。
+# 交易日保存为有序的 datetime64 数组，并建立 日期 -> 序号 的映射，前后移动若干个交易日只是数组下标运算
+class TradeCalendar:
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, file=TRADE_DATES_FILE):
+        self.file = file
+        self.dates = np.array([], dtype='datetime64[ns]')  # 有序、去重的交易日
+        self.ordinals = {}  # pd.Timestamp -> 在 self.dates 中的序号
+        self._mtime = None  # 加载时文件的修改时间
+        self._checked_at = None  # 上次检查修改时间的时刻（time.monotonic）
+        self._load_lock = threading.Lock()
+
+    # 获取某个交易日文件对应的日历（同一进程内是同一个对象），第一次获取时加载文件
+    @classmethod
+    def instance(cls, file=TRADE_DATES_FILE):
+        key = os.path.abspath(file)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(file)
+            calendar = cls._instances[key]
+        calendar.refresh_if_needed()
+        return calendar
+
+    # 没有加载过，或者距离上次检查超过 CHECK_INTERVAL 秒且文件已被重新生成，才重新加载
+    def refresh_if_needed(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < CHECK_INTERVAL:
+            return
+        with self._load_lock:
+            if self._checked_at is not None and now - self._checked_at < CHECK_INTERVAL:
+                return
+            if os.path.getmtime(self.file) != self._mtime:
+                self.load()
+            self._checked_at = now
+
+    def load(self):
+        self._mtime = os.path.getmtime(self.file)
+        trade_dates = pd.to_datetime(pd.read_pickle(self.file)['trade_date'])
+        dates = np.unique(trade_dates.to_numpy(dtype='datetime64[ns]'))
+        # 先建好新的映射再一起替换，其它线程不会看到只更新了一半的日历
+        self.dates, self.ordinals = dates, {pd.Timestamp(date): ordinal for ordinal, date in enumerate(dates)}
+
+    # 交易日文件被重新生成后重新加载
+    def reload(self):
+        self.load()
+        return self
+
+    def __len__(self):
+        return len(self.dates)
+
+    def is_trade_date(self, date):
+        return pd.Timestamp(date) in self.ordinals
+
+    # 交易日的序号，不是交易日时返回None
+    def ordinal(self, date):
+        return self.ordinals.get(pd.Timestamp(date))
+
+    # 第一个 >= date 的交易日的序号（side='right' 时为第一个 > date 的交易日的序号）
+    def searchsorted(self, date, side='left'):
+        return int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date), 'ns'), side=side))
+
+    def date_at(self, ordinal):
+        return pd.Timestamp(self.dates[ordinal])
+
+    # date之后的下一个交易日，没有时返回None
+    def next(self, date):
+        index = self.searchsorted(date, side='right')
+        return self.date_at(index) if index < len(self.dates) else None
+
+    # date之前的上一个交易日，没有时返回None
+    def prev(self, date):
+        index = self.searchsorted(date, side='left') - 1
+        return self.date_at(index) if index >= 0 else None
+
+    # 从date当天（不是交易日时为之后最近的交易日）移动n个交易日，超出日历范围时取日历的第一天/最后一天
+    def offset(self, date, n):
+        index = self.searchsorted(date) + n
+        return self.date_at(min(max(index, 0), len(self.dates) - 1))
+
+    # [start_date, end_date] 之间的所有交易日
+    def range(self, start_date=None, end_date=None):
+        start = self.searchsorted(start_date) if start_date is not None else 0
+        end = self.searchsorted(end_date, side='right') if end_date is not None else len(self.dates)
+        return pd.DatetimeIndex(self.dates[start:end])
+
+    # 与原 trade_dates.pkl 相同格式的 DataFrame（只有 trade_date 一列）
+    def to_frame(self):
+        return pd.DataFrame({'trade_date': pd.DatetimeIndex(self.dates)})